@@ -0,0 +1,215 @@
+# Imports
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from searcher3 import (
+    CHAIN_PROMPTS,
+    ConversationType,
+    Religion,
+    build_chain,
+    enum_member,
+    invoke_chain,
+    setup_embeddings_and_vector_store,
+    setup_llm,
+)
+
+logger = logging.getLogger(__name__)
+
+# Provider limits
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # Jobs in flight at once
+BATCH_REQUESTS_PER_MINUTE = float(os.getenv("BATCH_REQUESTS_PER_MINUTE", "60"))  # 0 for no limit
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Output statuses that count as finished when resuming; "error" jobs are tried again
+FINISHED_STATUSES = ("ok", "invalid")
+
+
+def job_id(job):
+    """The job's "id", or a digest of its religion, conversation type and input"""
+    if job.get("id") is not None:
+        return str(job["id"])
+    key = "|".join(str(job.get(field, "")) for field in ("religion", "conversation_type", "input"))
+    return hashlib.sha256(key.encode('UTF-8')).hexdigest()[:16]
+
+
+def read_jobs(path):
+    """Yields job dicts from a JSONL file of {"religion", "conversation_type", "input"} objects"""
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                problem = None if isinstance(job, dict) else "is not a JSON object"
+            except ValueError:
+                problem = "is not valid JSON"
+            if problem:
+                # Recorded as invalid under a digest of the line, so a resumed run skips it too
+                logger.error("Invalid job on line %d: %s", line_number, problem)
+                job = {"id": job_id({"input": line.strip()}), "malformed": f"Line {line_number} {problem}"}
+            job["id"] = job_id(job)
+            yield job
+
+
+def finished_job_ids(path):
+    """IDs already written to the output file; a truncated last line from an interrupted run is ignored"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("status") in FINISHED_STATUSES:
+                finished.add(result["id"])
+    return finished
+
+
+def parse_job(job):
+    """Returns (religion, conversation type), or raises ValueError for an unknown or unavailable pair"""
+    if "malformed" in job:
+        raise ValueError(job["malformed"])
+    religion = enum_member(Religion, str(job.get("religion", "")))
+    conv_type = enum_member(ConversationType, str(job.get("conversation_type", "")))
+    if conv_type not in CHAIN_PROMPTS[religion]:
+        raise ValueError(f"{conv_type.value} is not available for {religion.value}")
+    if not str(job.get("input", "")).strip():
+        raise ValueError("Empty input")
+    return religion, conv_type
+
+
+class RateLimiter:
+    """Spaces request starts at least 60 / requests_per_minute seconds apart"""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self.next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def backoff_seconds(attempt):
+    """Exponential backoff with jitter: about 1s, 2s, 4s, ... capped at BACKOFF_MAX_SECONDS"""
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def run_job(job, chains, executor, semaphore, limiter, max_retries):
+    """Runs one job with retries and returns its output record"""
+    religion, conv_type = job["parsed"]
+    record = {"id": job["id"], "religion": religion.value, "conversation_type": conv_type.value, "input": job["input"]}
+    chain = chains[(religion, conv_type)]
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            await limiter.acquire()
+            started = time.perf_counter()
+            try:
+                # No memory and no history: every job is an independent first turn
+                output = await loop.run_in_executor(
+                    executor, lambda: invoke_chain(chain, religion, job["input"], [], conv_type=conv_type))
+                return {**record, "status": "ok", "output": output, "attempts": attempt + 1,
+                        "seconds": round(time.perf_counter() - started, 3)}
+            except Exception as e:
+                if attempt == max_retries:
+                    logger.error("Job %s failed after %d attempts: %r", job["id"], attempt + 1, e)
+                    return {**record, "status": "error", "error": repr(e), "attempts": attempt + 1}
+                delay = backoff_seconds(attempt)
+                logger.warning("Job %s attempt %d failed (%r); retrying in %.1fs", job["id"], attempt + 1, e, delay)
+                await asyncio.sleep(delay)
+
+
+def build_batch_chains(llm, jobs):
+    """Memoryless chains for the (religion, conversation type) pairs the jobs use"""
+    pairs = {job["parsed"] for job in jobs}
+    # Meditation does not retrieve, so a meditation-only batch never loads the embedding model
+    needs_retriever = any(conv_type != ConversationType.MEDITATION for _, conv_type in pairs)
+    retriever = setup_embeddings_and_vector_store() if needs_retriever else None
+    return {(religion, conv_type): build_chain(llm, retriever, None, religion, conv_type)
+            for religion, conv_type in pairs}
+
+
+async def run_batch(jobs_path, output_path, llm, concurrency=BATCH_CONCURRENCY,
+                    requests_per_minute=BATCH_REQUESTS_PER_MINUTE, max_retries=BATCH_MAX_RETRIES):
+    """Runs every unfinished job in jobs_path, appending one JSON line per job to output_path as it completes"""
+    finished = finished_job_ids(output_path)
+    jobs, invalid, skipped = [], [], 0
+    for job in read_jobs(jobs_path):
+        if job["id"] in finished:
+            skipped += 1
+            continue
+        finished.add(job["id"])  # Duplicate jobs in the input run once
+        try:
+            job["parsed"] = parse_job(job)
+            jobs.append(job)
+        except ValueError as e:
+            invalid.append({"id": job["id"], "status": "invalid", "error": str(e), "input": job.get("input")})
+    print(f"{len(jobs)} jobs to run, {len(invalid)} invalid, {skipped} already done")
+
+    started = time.perf_counter()
+    counts = {"ok": 0, "error": 0, "invalid": len(invalid)}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    try:
+        chains = build_batch_chains(llm, jobs) if jobs else {}
+        semaphore = asyncio.Semaphore(concurrency)
+        limiter = RateLimiter(requests_per_minute)
+        with open(output_path, 'a', encoding='UTF-8') as out:
+            for record in invalid:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            tasks = [asyncio.create_task(run_job(job, chains, executor, semaphore, limiter, max_retries))
+                     for job in jobs]
+            for done in asyncio.as_completed(tasks):
+                record = await done
+                # One complete line per job, flushed, so an interrupted run resumes where it stopped
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                counts[record["status"]] += 1
+                completed = counts["ok"] + counts["error"]
+                if completed % 50 == 0 or completed == len(jobs):
+                    elapsed = time.perf_counter() - started
+                    print(f"{completed}/{len(jobs)} done ({counts['error']} failed), "
+                          f"{completed / elapsed * 60:.1f} jobs/min")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return counts
+
+
+def main():
+    """Generates meditation scripts, prayers and other answers in bulk from a JSONL file of jobs"""
+    parser = argparse.ArgumentParser(description="Run (religion, conversation_type, input) jobs in bulk.")
+    parser.add_argument("jobs", help='JSONL, one {"religion", "conversation_type", "input"[, "id"]} per line')
+    parser.add_argument("output", help="JSONL results, appended to; rerun with the same file to resume")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--requests-per-minute", type=float, default=BATCH_REQUESTS_PER_MINUTE)
+    parser.add_argument("--max-retries", type=int, default=BATCH_MAX_RETRIES)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+
+    # Whole answers are written to the output, so tokens do not need to be streamed
+    counts = asyncio.run(run_batch(args.jobs, args.output, setup_llm(streaming=False), args.concurrency,
+                                   args.requests_per_minute, args.max_retries))
+    print(f"Finished: {counts}")
+
+
+if __name__ == "__main__":
+    main()
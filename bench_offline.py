@@ -0,0 +1,270 @@
+# Imports
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+
+from bench_retrieval import SAMPLE_QUERIES
+from indexer import batch_size, chunk_size, export_local_index
+from lexical_index import tokenize
+from local_index import LocalVectorIndex
+from reference_index import BOOK_ALIASES
+from searcher3 import CHAIN_PROMPTS, Religion, initialize_chains, invoke_chain, setup_memory, setup_retriever
+from streaming import TurnMetrics, run_turn
+from telemetry import REGISTRY
+
+# Roughly the size of a protocanonical Bible (31,102 verses)
+SYNTHETIC_VERSES = 31102
+SYNTHETIC_VOCABULARY = 6000
+# Words the sample queries use, so dense and BM25 search have something to find
+THEME_WORDS = sorted({token for query in SAMPLE_QUERIES for token in tokenize(query) if len(token) > 3})
+REFERENCE_QUERIES = ["What does John 3:16 mean?", "Explain Psalm 23:1-4", "Romans 8:28"]
+# Follow-ups exercise question condensing and chat history
+FOLLOW_UPS = ["Can you say more about that?", "How do I apply this today?"]
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embedder: each token adds +1 or -1 to a hashed bucket"""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            bucket, sign = token_bucket(token, self.dim)
+            vector[bucket] += sign
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+@lru_cache(maxsize=65536)
+def token_bucket(token, dim):
+    digest = int.from_bytes(hashlib.blake2b(token.encode('UTF-8'), digest_size=8).digest(), "little")
+    return digest % dim, 1.0 if digest >> 63 else -1.0
+
+
+class FakeLLM(LLM):
+    """Stand-in for VertexAI that waits `latency` seconds, then streams words at `tokens_per_second`"""
+
+    latency: float = 0.05
+    tokens_per_second: float = 200.0
+    answer_tokens: int = 40
+    condensed_tokens: int = 12
+
+    @property
+    def _llm_type(self):
+        return "fake-streaming"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        # Condensing and summary prompts get short answers, like the real model
+        words = self.condensed_tokens if "Follow Up Input" in prompt or "New summary" in prompt else self.answer_tokens
+        tokens = []
+        for i in range(words):
+            time.sleep(1 / self.tokens_per_second)
+            token = f"word{i} "
+            tokens.append(token)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return "".join(tokens).strip()
+
+
+def write_synthetic_corpus(path, verses=SYNTHETIC_VERSES, seed=0):
+    """Writes "Book C:V text" lines in the indexer's input format; returns the number of verses"""
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ra", "te", "shu", "an", "el", "yo", "be", "th", "na", "di", "or", "ze"]
+    vocabulary = THEME_WORDS + sorted({"".join(rng.choices(syllables, k=rng.randint(2, 4)))
+                                       for _ in range(SYNTHETIC_VOCABULARY)})
+    # Zipf-like word frequencies, as in natural text
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    rng.shuffle(weights)
+
+    books = list(BOOK_ALIASES)
+    per_book = verses // len(books) + 1
+    written = 0
+    with open(path, 'w', encoding='UTF-8') as f:
+        for book in books:
+            chapter = 0
+            book_verses = 0
+            while book_verses < per_book and written < verses:
+                chapter += 1
+                for verse in range(1, rng.randint(10, 40) + 1):
+                    text = " ".join(rng.choices(vocabulary, weights, k=rng.randint(8, 30)))
+                    f.write(f"{book} {chapter}:{verse} {text}.\n")
+                    written += 1
+                    book_verses += 1
+    return written
+
+
+def latency_summary(seconds):
+    """Mean, p50 and p99 in milliseconds"""
+    ms = sorted(s * 1000 for s in seconds)
+    if not ms:
+        return {}
+    return {
+        "count": len(ms),
+        "mean_ms": round(statistics.mean(ms), 3),
+        "p50_ms": round(statistics.median(ms), 3),
+        "p99_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.99))], 3),
+    }
+
+
+def max_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS); None on Windows"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def bench_indexing(corpus, embeddings, directory, reference_index):
+    started = time.perf_counter()
+    chunks = export_local_index([corpus], embeddings, directory, batch=batch_size, reference_index=reference_index)
+    elapsed = time.perf_counter() - started
+    return {"chunks": chunks, "seconds": round(elapsed, 3), "chunks_per_second": round(chunks / elapsed, 1)}
+
+
+def bench_retrievers(retrievers, rounds):
+    """Per-query latency of each retriever over the sample and reference queries"""
+    queries = SAMPLE_QUERIES + REFERENCE_QUERIES
+    results = {}
+    for name, retriever in retrievers.items():
+        retriever.invoke(queries[0])
+        latencies = []
+        for _ in range(rounds):
+            for query in queries:
+                started = time.perf_counter()
+                retriever.invoke(query)
+                latencies.append(time.perf_counter() - started)
+        results[name] = latency_summary(latencies)
+    return results
+
+
+def timed_turn(chain, religion, conv_type, query, chat_history):
+    """Runs one streamed turn and returns (answer, TurnMetrics)"""
+    metrics = TurnMetrics()
+    answers, errors = [], []
+
+    def emit(event):
+        kind, payload = event
+        if kind == "token":
+            metrics.on_token()
+        elif kind == "done":
+            answers.append(payload)
+        elif kind == "error":
+            errors.append(payload)
+
+    run_turn(lambda callbacks: invoke_chain(chain, religion, query, chat_history, callbacks, conv_type), emit)
+    metrics.finish()
+    if errors:
+        raise errors[0]
+    return answers[0], metrics
+
+
+def bench_turns(llm, retriever, religion, conversations):
+    """End-to-end turn latency per conversation type; every conversation is a question plus follow-ups"""
+    chains = initialize_chains(llm, retriever)
+    results = {}
+    for conv_type, chain in chains[religion].items():
+        first_token, total, rates = [], [], []
+        for i in range(conversations):
+            memory = setup_memory(llm)
+            for query in [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]] + FOLLOW_UPS:
+                chat_history = memory.load_memory_variables({})["chat_history"]
+                answer, metrics = timed_turn(chain, religion, conv_type, query, chat_history)
+                memory.save_context({"question": query}, {"answer": answer})
+                metrics = metrics.as_dict()
+                first_token.append(metrics["time_to_first_token"] or metrics["total_time"])
+                total.append(metrics["total_time"])
+                if metrics["tokens_per_second"]:
+                    rates.append(metrics["tokens_per_second"])
+        results[conv_type.value] = {
+            "time_to_first_token": latency_summary(first_token),
+            "total": latency_summary(total),
+            "tokens_per_second": round(statistics.mean(rates), 1) if rates else None,
+        }
+    return results
+
+
+def main():
+    """Benchmarks indexing, retrieval and conversation turns without Vertex AI or Qdrant"""
+    parser = argparse.ArgumentParser(description="Offline benchmark with a fake LLM and deterministic embeddings.")
+    parser.add_argument("--verses", type=int, default=SYNTHETIC_VERSES)
+    parser.add_argument("--rounds", type=int, default=20, help="Retrieval rounds over the sample queries")
+    parser.add_argument("--conversations", type=int, default=3, help="Conversations per conversation type")
+    parser.add_argument("--religion", choices=[r.name for r in Religion], default=Religion.CATHOLICISM.name)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--embedding-dim", type=int, default=384)
+    parser.add_argument("--output", default="bench_offline.json")
+    args = parser.parse_args()
+
+    embeddings = HashEmbeddings(args.embedding_dim)
+    llm = FakeLLM(latency=args.llm_latency, tokens_per_second=args.tokens_per_second,
+                  answer_tokens=args.answer_tokens)
+    religion = Religion[args.religion]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus = os.path.join(workdir, "synthetic_bible.txt")
+        index_dir = os.path.join(workdir, "index")
+        reference_index = os.path.join(index_dir, "reference.json")
+        verses = write_synthetic_corpus(corpus, args.verses)
+        indexing = bench_indexing(corpus, embeddings, index_dir, reference_index)
+        indexing["verses_per_second"] = round(verses / indexing["seconds"], 1)
+        rss_after_indexing = max_rss_mb()
+
+        # Only loading is traced; tracing the timed phases would skew their latencies
+        tracemalloc.start()
+        store = LocalVectorIndex.load(embeddings, index_dir)
+        retrievers = {mode: setup_retriever(store, mode, index_dir, reference_index) for mode in ("dense", "hybrid")}
+        index_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        retrieval = bench_retrievers(retrievers, args.rounds)
+        turns = bench_turns(llm, retrievers["dense"], religion, args.conversations)
+
+    results = {
+        "config": {**vars(args), "chunk_size": chunk_size, "verses": verses,
+                   "conversation_types": [t.value for t in CHAIN_PROMPTS[religion]]},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "numpy": np.__version__},
+        "indexing": indexing,
+        "retrieval": retrieval,
+        "turns": turns,
+        # Stage histograms and token/cache counters from telemetry.py
+        "telemetry": REGISTRY.dump(),
+        "memory": {
+            "index_resident_mb": round(index_bytes / (1024 * 1024), 1),
+            "max_rss_after_indexing_mb": rss_after_indexing,
+            "max_rss_mb": max_rss_mb(),
+        },
+    }
+    with open(args.output, 'w', encoding='UTF-8') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
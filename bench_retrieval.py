@@ -0,0 +1,95 @@
+# Imports
+import argparse
+import os
+import statistics
+import time
+
+from langchain_qdrant import QdrantVectorStore
+
+from embedding_cache import setup_cached_embeddings
+from indexer import COLLECTION_NAME, QDRANT_API_KEY, QDRANT_URL
+from lexical_index import BM25Index, HybridRetriever
+from local_index import LOCAL_INDEX_DIR, LocalVectorIndex
+
+# Typical user questions across the conversation types
+SAMPLE_QUERIES = [
+    "What does the Bible say about forgiveness?",
+    "I need a prayer for anxiety before my exam",
+    "I lied to my parents and feel guilty",
+    "Help me trust God when I am afraid",
+    "Who was Melchizedek?",
+    "How should I treat my enemies?",
+    "Verses about hope in times of grief",
+    "What did Jesus teach about prayer?",
+]
+
+
+def time_retriever(retriever, queries, rounds):
+    """Returns per-query latencies in milliseconds"""
+    latencies = []
+    for _ in range(rounds):
+        for query in queries:
+            started = time.perf_counter()
+            retriever.invoke(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+class BM25Retriever:
+    """Minimal invoke() adapter so the BM25 search alone can be timed"""
+
+    def __init__(self, lexical):
+        self.lexical = lexical
+
+    def invoke(self, query):
+        return self.lexical.search(query, 10)
+
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<8} mean {statistics.mean(latencies):8.3f} ms   p50 {statistics.median(latencies):8.3f} ms   "
+          f"p99 {p99:8.3f} ms")
+
+
+def main():
+    """Compares MMR retrieval latency of the local index against the Qdrant collection"""
+    parser = argparse.ArgumentParser(description="Benchmark local vs Qdrant retrieval latency.")
+    parser.add_argument("--local-index", default=LOCAL_INDEX_DIR)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--skip-qdrant", action="store_true")
+    args = parser.parse_args()
+
+    embeddings = setup_cached_embeddings()
+    search_kwargs = {"k": 2}
+    backends = {"local": LocalVectorIndex.load(embeddings, args.local_index)}
+    if not args.skip_qdrant:
+        backends["qdrant"] = QdrantVectorStore.from_existing_collection(
+            embedding=embeddings,
+            collection_name=COLLECTION_NAME,
+            url=QDRANT_URL,
+            api_key=QDRANT_API_KEY or None,
+        )
+
+    # Warm up once per backend so the query embeddings are cached and only search time is compared
+    retrievers = {name: store.as_retriever(search_type="mmr", search_kwargs=search_kwargs)
+                  for name, store in backends.items()}
+    for retriever in retrievers.values():
+        time_retriever(retriever, SAMPLE_QUERIES, 1)
+
+    print(f"{len(SAMPLE_QUERIES)} queries x {args.rounds} rounds, MMR k={search_kwargs['k']}")
+    for name, retriever in retrievers.items():
+        summarize(name, time_retriever(retriever, SAMPLE_QUERIES, args.rounds))
+
+    # Hybrid adds the BM25 side on top of the dense search
+    if os.path.exists(os.path.join(args.local_index, "bm25.npz")):
+        lexical = BM25Index.load(args.local_index)
+        summarize("bm25", time_retriever(BM25Retriever(lexical), SAMPLE_QUERIES, args.rounds))
+        hybrid = HybridRetriever.from_directory(
+            backends["local"].as_retriever(search_type="mmr", search_kwargs={"k": 10}), args.local_index)
+        time_retriever(hybrid, SAMPLE_QUERIES, 1)
+        summarize("hybrid", time_retriever(hybrid, SAMPLE_QUERIES, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
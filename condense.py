@@ -0,0 +1,129 @@
+# Imports
+import os
+import re
+import threading
+import time
+from typing import Any
+
+from langchain.chains.base import Chain
+
+from reference_index import contains_reference
+
+# How follow-up questions are rewritten before retrieval:
+#   "none"      - always use the question as typed
+#   "heuristic" - call the LLM only when the question refers back to the conversation
+#   "local"     - like "heuristic", but append the previous question instead of calling the LLM
+#   "llm"       - always call the LLM (LangChain's default behaviour)
+CONDENSE_STRATEGIES = ("none", "heuristic", "local", "llm")
+CONDENSE_STRATEGY = os.getenv("CONDENSE_STRATEGY", "heuristic")
+
+# Openings and phrases that only make sense with the previous turns. Pronouns elsewhere in
+# a question ("Is there a verse about hope?", "why is he important?") are not enough.
+_LEADING_BACK_REFERENCE = re.compile(
+    r"^\W*(and|but|so|also|then|what about|how about|what else|why not|"
+    r"it|its|this|that|these|those|they|them|he|him|his|she|her)\b",
+    re.IGNORECASE,
+)
+_BACK_REFERENCE = re.compile(
+    r"\b(you said|you mentioned|you quoted|you wrote|your (answer|prayer|explanation)|"
+    r"(the|that|this|those|these) (verses?|passages?|prayer|penance|meditation)|"
+    r"(does|did|do) (it|that|this|they) mean|mean by (it|that|this)|"
+    r"(say|tell me|explain) more|elaborate|expand on|"
+    r"(apply|do|pray|read) (it|this|that)|(that|this|it) in the bible|"
+    r"the (first|second|third|last) one|as above|earlier|previous|again)\b",
+    re.IGNORECASE,
+)
+_TRAILING_BACK_REFERENCE = re.compile(r"\b(about|after|before) (it|that|this|him|her|them)\W*$", re.IGNORECASE)
+_SHORT_FOLLOW_UP_WORDS = 3
+_HUMAN_PREFIX = "Human: "
+
+
+def refers_back(question):
+    """True when the question likely needs the chat history to be understood"""
+    # A cited passage is served as typed by the reference fast path; rewriting it could change the reference
+    if contains_reference(question):
+        return False
+    if len(question.split()) <= _SHORT_FOLLOW_UP_WORDS:
+        return True
+    patterns = (_LEADING_BACK_REFERENCE, _BACK_REFERENCE, _TRAILING_BACK_REFERENCE)
+    return any(pattern.search(question) for pattern in patterns)
+
+
+def last_user_question(chat_history):
+    """Last human turn from the chat history string built by ConversationalRetrievalChain"""
+    for line in reversed(chat_history.splitlines()):
+        if line.startswith(_HUMAN_PREFIX):
+            return line[len(_HUMAN_PREFIX):].strip()
+    return ""
+
+
+class CondenseStats:
+    """Counts condensing decisions and the time spent in LLM condensing calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"passthrough": 0, "local": 0, "llm": 0}
+        self.llm_seconds = 0.0
+
+    def record(self, outcome, seconds=0.0):
+        with self._lock:
+            self.counts[outcome] += 1
+            if outcome == "llm":
+                self.llm_seconds += seconds
+
+    def as_dict(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            llm_calls = self.counts["llm"]
+            average_llm = self.llm_seconds / llm_calls if llm_calls else None
+            avoided = total - llm_calls
+            return {
+                **self.counts,
+                "avoided_llm_calls": avoided,
+                "avoided_ratio": avoided / total if total else 0.0,
+                "average_llm_seconds": average_llm,
+                # Estimated from the average of the LLM condensing calls that did run
+                "estimated_seconds_saved": avoided * average_llm if average_llm is not None else None,
+            }
+
+
+CONDENSE_STATS = CondenseStats()
+
+
+class CondenseQuestionChain(Chain):
+    """Drop-in question_generator for ConversationalRetrievalChain that only calls the LLM when needed"""
+
+    llm_chain: Any
+    strategy: str = CONDENSE_STRATEGY
+    stats: Any = CONDENSE_STATS
+
+    @property
+    def input_keys(self):
+        return ["question", "chat_history"]
+
+    @property
+    def output_keys(self):
+        return ["text"]
+
+    def _call(self, inputs, run_manager=None):
+        question, chat_history = inputs["question"], inputs["chat_history"]
+        if self.strategy not in CONDENSE_STRATEGIES:
+            raise ValueError(f"Unknown condense strategy: {self.strategy}")
+
+        if self.strategy == "none" or (self.strategy in ("heuristic", "local") and not refers_back(question)):
+            self.stats.record("passthrough")
+            return {"text": question}
+
+        if self.strategy == "local":
+            previous = last_user_question(chat_history)
+            self.stats.record("local")
+            return {"text": f"{question} (following up on: {previous})" if previous else question}
+
+        started = time.perf_counter()
+        text = self.llm_chain.run(
+            question=question,
+            chat_history=chat_history,
+            callbacks=run_manager.get_child() if run_manager else None,
+        )
+        self.stats.record("llm", time.perf_counter() - started)
+        return {"text": text}
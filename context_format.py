@@ -0,0 +1,127 @@
+# Imports
+import json
+import os
+import threading
+from functools import lru_cache
+from typing import Any
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from reference_index import format_reference
+
+# Upper bound on the {context} size, in approximate tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+_CHARS_PER_TOKEN = 4
+
+
+def approximate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English text)"""
+    return len(text) // _CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text, max_tokens, marker=" […]"):
+    """Keeps the start of text, cut at a word boundary, so that approximate_tokens() stays within max_tokens"""
+    if approximate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max(0, (max_tokens - 1) * _CHARS_PER_TOKEN - len(marker))]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip() + marker
+
+
+@lru_cache(maxsize=4096)
+def parse_chunk(page_content):
+    """Returns ((book, chapter, verse, text), ...) for a JSON chunk written by indexer.py, or None"""
+    try:
+        chunk = json.loads(page_content)
+        return tuple((chunk["book"], chunk["chapter"], entry["verse"], entry["text"]) for entry in chunk["verse_map"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def document_verses(doc):
+    """Structured verses of a retrieved document, or None for free text"""
+    if "passage" in doc.metadata:
+        return doc.metadata["passage"]
+    return parse_chunk(doc.page_content)
+
+
+def compact_documents(docs, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """Renders documents as "Book C:V text" lines, dropping repeated verses and stopping at max_tokens.
+
+    Documents keep their order (best first) and metadata; a "reference" label is
+    added so callers can still cite them.
+    """
+    seen = set()
+    budget = max_tokens
+    compacted = []
+    for doc in docs:
+        verses = document_verses(doc)
+        if verses is None:
+            lines = [doc.page_content]
+            kept = None
+        else:
+            kept = [v for v in verses if (v[0], v[1], v[2]) not in seen]
+            seen.update((v[0], v[1], v[2]) for v in kept)
+            lines = [f"{book} {chapter}:{verse} {text}" for book, chapter, verse, text in kept]
+
+        taken = []
+        for line in lines:
+            cost = approximate_tokens(line)
+            if cost > budget and (taken or compacted):
+                break
+            taken.append(line)
+            budget -= cost
+        if taken:
+            metadata = dict(doc.metadata)
+            if kept:
+                metadata.setdefault("reference", format_reference(kept[:len(taken)]))
+            compacted.append(Document(id=doc.id, page_content="\n".join(taken), metadata=metadata))
+        if budget <= 0:
+            break
+    return compacted
+
+
+class ContextStats:
+    """Prompt context size before and after compaction"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.raw_tokens = 0
+        self.compact_tokens = 0
+
+    def record(self, raw_docs, compact_docs):
+        raw = sum(approximate_tokens(doc.page_content) for doc in raw_docs)
+        compact = sum(approximate_tokens(doc.page_content) for doc in compact_docs)
+        with self._lock:
+            self.requests += 1
+            self.raw_tokens += raw
+            self.compact_tokens += compact
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "raw_tokens": self.raw_tokens,
+                "compact_tokens": self.compact_tokens,
+                "reduction": 1 - self.compact_tokens / self.raw_tokens if self.raw_tokens else 0.0,
+            }
+
+
+CONTEXT_STATS = ContextStats()
+
+
+class CompactContextRetriever(BaseRetriever):
+    """Wraps a retriever so the prompts receive compact, deduplicated, budgeted context"""
+
+    retriever: BaseRetriever
+    max_tokens: int = CONTEXT_TOKEN_BUDGET
+    stats: Any = CONTEXT_STATS
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        compacted = compact_documents(docs, self.max_tokens)
+        self.stats.record(docs, compacted)
+        return compacted
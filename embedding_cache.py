@@ -0,0 +1,280 @@
+# Imports
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from telemetry import record_cache, span
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Model shared by indexer.py and searcher3.py
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+MEMORY_CACHE_SIZE = 4096
+
+
+def cache_key(model_name, kind, text):
+    """16-byte digest of model name, embedding kind (query/document) and text"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (model_name, kind, text):
+        digest.update(part.encode('UTF-8'))
+        digest.update(b"\0")
+    return digest.digest()
+
+
+def lock_file(f):
+    """Blocks until this process holds the exclusive lock on the open file f"""
+    if os.name == "nt":
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:  # LK_LOCK gives up after about 10 seconds
+                continue
+    fcntl.flock(f, fcntl.LOCK_EX)
+
+
+def unlock_file(f):
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DiskVectorCache:
+    """Append-only float32 vector file with a compact key index, memory-mapped for reads.
+
+    `keys.bin` holds one 16-byte digest per row of `vectors.f32`, and the number
+    of complete keys is the number of valid rows. Vectors are written before
+    keys, and new rows are written right after the last keyed row, so rows left
+    without a key by a crash are overwritten (or truncated) by the next write.
+    Writers from several processes are serialized with a file lock.
+    """
+
+    KEY_SIZE = 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.keys_path = os.path.join(directory, "keys.bin")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.lock_path = os.path.join(directory, "lock")
+        self.dim = None
+        self.rows = {}
+        self.count = 0  # Rows in vectors.f32 that have a key
+        self._vectors = None
+        with self._locked():
+            self._load()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock shared by every process using this directory"""
+        with open(self.lock_path, 'a+b') as lock:
+            lock_file(lock)
+            try:
+                yield
+            finally:
+                unlock_file(lock)
+
+    def _load(self):
+        """Reads keys appended since the last load and drops unkeyed rows. Must be called with the file lock held."""
+        if self.dim is None:
+            try:
+                with open(self.meta_path, 'r', encoding='UTF-8') as f:
+                    self.dim = json.load(f)["dim"]
+            except (OSError, ValueError, KeyError):
+                return  # Nothing written yet
+        if not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self.count * self.KEY_SIZE)
+            keys = f.read()
+        stored_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        new_rows = max(0, min(len(keys) // self.KEY_SIZE, stored_rows - self.count))
+        for i in range(new_rows):
+            self.rows.setdefault(keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE], self.count + i)
+        self.count += new_rows
+        # A partial key, or vectors written without their keys, are what an interrupted write leaves
+        if (os.path.getsize(self.keys_path) > self.count * self.KEY_SIZE
+                or os.path.getsize(self.vectors_path) > self.count * self.dim * 4):
+            self._vectors = None  # Windows cannot truncate a file this process has mapped
+            try:
+                os.truncate(self.keys_path, self.count * self.KEY_SIZE)
+                os.truncate(self.vectors_path, self.count * self.dim * 4)
+            except OSError:
+                pass  # Mapped by another process on Windows; the next write overwrites these rows
+        self._map()
+
+    def _map(self):
+        if self.count:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+
+    def _create(self, dim):
+        """Creates the data files, then meta.json atomically, so a crash never leaves meta.json without them"""
+        open(self.keys_path, 'ab').close()
+        open(self.vectors_path, 'ab').close()
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump({"dim": dim}, f)
+        os.replace(tmp_path, self.meta_path)
+        self.dim = dim
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        """Returns the cached vector for key, or None"""
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self._vectors is None or row >= self._vectors.shape[0]:
+            self._map()
+        return np.array(self._vectors[row])
+
+    def put_many(self, keys, vectors):
+        """Stores new vectors; keys already present, here or from another process, are ignored"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked():
+            # Picks up other writers' rows, so new rows are numbered after theirs
+            self._load()
+            if self.dim is None or not (os.path.exists(self.keys_path) and os.path.exists(self.vectors_path)):
+                self._create(vectors.shape[1])
+
+            fresh = {}
+            for i, key in enumerate(keys):
+                if key not in self.rows:
+                    fresh.setdefault(key, i)
+            if not fresh:
+                return
+            start = self.count
+            # Written at the end of the keyed rows, over anything an interrupted write left behind
+            with open(self.vectors_path, 'r+b') as f:
+                f.seek(start * self.dim * 4)
+                f.write(vectors[list(fresh.values())].tobytes())
+            with open(self.keys_path, 'r+b') as f:
+                f.seek(start * self.KEY_SIZE)
+                f.write(b"".join(fresh))
+            for offset, key in enumerate(fresh):
+                self.rows[key] = start + offset
+            self.count += len(fresh)
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings object with an in-process LRU and a persistent on-disk vector cache"""
+
+    def __init__(self, embeddings, model_name, cache_dir=EMBEDDING_CACHE_DIR, memory_size=MEMORY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        slug = hashlib.blake2b(model_name.encode('UTF-8'), digest_size=8).hexdigest()
+        self.disk = DiskVectorCache(os.path.join(cache_dir, slug))
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Checks the LRU, then the disk cache. Must be called with the lock held."""
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return vector
+        vector = self.disk.get(key)
+        if vector is not None:
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _store(self, keys, vectors):
+        with self._lock:
+            self.disk.put_many(keys, vectors)
+            for key, vector in zip(keys, vectors):
+                self._remember(key, np.asarray(vector, dtype=np.float32))
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.model_name, "document", text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._lookup(key)
+                if vector is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    results[i] = vector
+            self.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            vectors = self.embeddings.embed_documents([texts[missing[key][0]] for key in missing_keys])
+            self._store(missing_keys, vectors)
+            for key, vector in zip(missing_keys, vectors):
+                for i in missing[key]:
+                    results[i] = vector
+
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in results]
+
+    def embed_query(self, text):
+        with span("embed"):
+            key = cache_key(self.model_name, "query", text)
+            with self._lock:
+                vector = self._lookup(key)
+                if vector is None:
+                    self.misses += 1
+            record_cache("embedding", vector is not None)
+            if vector is None:
+                vector = self.embeddings.embed_query(text)
+                self._store([key], [vector])
+            return np.asarray(vector, dtype=np.float32).tolist()
+
+    def stats(self):
+        """Hit/miss counters, for sizing the cache"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "disk_entries": len(self.disk),
+            }
+
+
+def setup_huggingface_embeddings():
+    """Sets up the HuggingFace embedding model, without caching"""
+    # Deferred: importing langchain_huggingface loads torch and sentence-transformers
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    model_kwargs = {'device': 'cpu'}
+    encode_kwargs = {'normalize_embeddings': False}
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs=model_kwargs,
+        encode_kwargs=encode_kwargs
+    )
+
+
+def setup_cached_embeddings(cache_dir=EMBEDDING_CACHE_DIR):
+    """Sets up HuggingFace embeddings behind the persistent embedding cache"""
+    return CachedEmbeddings(setup_huggingface_embeddings(), EMBEDDING_MODEL_NAME, cache_dir=cache_dir)
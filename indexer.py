@@ -1,75 +1,436 @@
 # Imports
 from langchain_qdrant import QdrantVectorStore
-from langchain_huggingface import HuggingFaceEmbeddings
+from qdrant_client import QdrantClient, models
+import argparse
+import hashlib
+import itertools
 import json
+import math
+import os
 import re
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-# Set up the embedding model
-model_name = 'sentence-transformers/all-MiniLM-L6-v2'
-model_kwargs = {'device': 'cpu'}
-encode_kwargs = {'normalize_embeddings': False}
-embeddings = HuggingFaceEmbeddings(
-    model_name=model_name,
-    model_kwargs=model_kwargs,
-    encode_kwargs=encode_kwargs
-)
+from langchain_core.embeddings import Embeddings
+
+from embedding_cache import EMBEDDING_MODEL_NAME, CachedEmbeddings, setup_cached_embeddings, setup_huggingface_embeddings
+from lexical_index import BM25Index
+from local_index import LOCAL_INDEX_DIR, LocalIndexWriter
+from reference_index import REFERENCE_INDEX_FILE, ReferenceIndexBuilder, translation_index_path
+
+# Qdrant connection (same environment variables as searcher3.py)
+QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
+COLLECTION_NAME = "Bible Chunks"
 
 # File path
 input_file = r""
 
-# Load verses from .txt file
-with open(input_file, 'r', encoding='UTF-8') as f:
-    lines = [line.strip() for line in f if line.strip()]
+# Chunking and batching
+chunk_size = 10
+batch_size = 64
+
+# Chunk sizes in verses per granularity; None means one chunk per chapter.
+# Each chunk's metadata records its granularity so the retriever can query one of them.
+GRANULARITIES = {"verse": 1, "window": chunk_size, "chapter": None}
+DEFAULT_GRANULARITIES = ["window"]
+
+# Processes for embedding; each loads its own copy of the embedding model
+WORKERS = int(os.getenv("INDEX_WORKERS", str(os.cpu_count() or 1)))
 
 # Regex to extract Book, Chapter, Verse
 verse_pattern = re.compile(r"^(.*?) (\d+):(\d+)\s+(.*)$")
 
-chunks = []
-chunk_size = 10
-temp_chunk = []
-verse_map = []
-
-for i, line in enumerate(lines):
-    match = verse_pattern.match(line)
-    if not match:
-        continue
-
-    book, chapter, verse, text = match.groups()
-    chapter, verse = int(chapter), int(verse)
-
-    temp_chunk.append(text)
-    verse_map.append({
-        "verse": verse,
-        "text": text
-    })
-
-    # Save chunk every N verses or at the end
-    is_last_line = i == len(lines) - 1
-    if len(temp_chunk) == chunk_size or is_last_line:
-        start_verse = verse_map[0]["verse"]
-        end_verse = verse_map[-1]["verse"]
-        full_text = " ".join(temp_chunk)
-
-        chunk_data = {
-            "book": book,
-            "chapter": chapter,
-            "verses": f"{start_verse}-{end_verse}",
-            "verse_map": verse_map.copy(),
-            "text": full_text
-        }
-
-        chunks.append(chunk_data)
-        temp_chunk = []
-        verse_map = []
-
-# Convert to JSON strings for embedding
-texts = [json.dumps(entry, ensure_ascii=False) for entry in chunks]
-
-# Upload to Qdrant
-doc_store = QdrantVectorStore.from_texts(
-    texts,
-    embeddings,
-    url="",
-    api_key="",
-    collection_name="Bible Chunks",
-)
+
+# Parsing and chunking
+def read_verses(path):
+    """Yields (book, chapter, verse, text) tuples from a .txt file, one line at a time"""
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line in f:
+            match = verse_pattern.match(line.strip())
+            if not match:
+                continue
+            book, chapter, verse, text = match.groups()
+            yield book, int(chapter), int(verse), text
+
+
+def iter_chunks(verses, size=chunk_size):
+    """Groups verses into chunks of up to `size` verses (whole chapters if size is None), never across chapters"""
+    temp_chunk = []
+    verse_map = []
+    book = chapter = None
+
+    for verse_book, verse_chapter, verse, text in verses:
+        if temp_chunk and (verse_book, verse_chapter) != (book, chapter):
+            yield make_chunk(book, chapter, verse_map, temp_chunk)
+            temp_chunk = []
+            verse_map = []
+        book, chapter = verse_book, verse_chapter
+
+        temp_chunk.append(text)
+        verse_map.append({
+            "verse": verse,
+            "text": text
+        })
+
+        if len(temp_chunk) == size:
+            yield make_chunk(book, chapter, verse_map, temp_chunk)
+            temp_chunk = []
+            verse_map = []
+
+    # Save the remaining verses at the end
+    if temp_chunk:
+        yield make_chunk(book, chapter, verse_map, temp_chunk)
+
+
+def make_chunk(book, chapter, verse_map, temp_chunk):
+    """Builds the chunk dict stored in Qdrant"""
+    start_verse = verse_map[0]["verse"]
+    end_verse = verse_map[-1]["verse"]
+    return {
+        "book": book,
+        "chapter": chapter,
+        "verses": f"{start_verse}-{end_verse}",
+        "verse_map": verse_map.copy(),
+        "text": " ".join(temp_chunk)
+    }
+
+
+def group_books(verses):
+    """Yields the verses of each book as one list, in file order"""
+    for _, book_verses in itertools.groupby(verses, key=lambda verse: verse[0]):
+        yield list(book_verses)
+
+
+def translation_name(source):
+    """Translation label stored in chunk metadata: the file name without extension, e.g. "kjv" """
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+def granularity_sizes(names=DEFAULT_GRANULARITIES, window=chunk_size):
+    """[(granularity, chunk size)] for the requested granularities, with the window size configurable"""
+    return [(name, window if name == "window" else GRANULARITIES[name]) for name in names]
+
+
+def batched(iterable, n):
+    """Yields lists of up to n items from iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Chunking and parallel embedding
+def chunk_book(source, verses, granularities):
+    """Chunks one book at every granularity into (id, text, metadata, chunk) tuples"""
+    chunks = []
+    for granularity, size in granularities:
+        for entry in iter_chunks(verses, size):
+            # Convert to JSON strings for embedding
+            text = json.dumps(entry, ensure_ascii=False)
+            digest = content_hash(text)
+            chunks.append((chunk_point_id(source, granularity, entry, digest), text,
+                           chunk_metadata(source, granularity, entry, digest), entry))
+    return chunks
+
+
+def iter_source_chunks(source, granularities, references=None, counts=None):
+    """Yields (id, text, metadata, chunk) for every chunk of a Bible text, holding one book in memory at a time.
+
+    Chunking stays in this process: it is cheaper than sending a book to a
+    worker and back, and only embedding is worth parallelizing. Verses are
+    passed through `references` when given, and `counts` (a Counter) receives
+    the number of source verses and of chunks per granularity.
+    """
+    source_name = os.path.basename(source)
+    verses = read_verses(source)
+    if references is not None:
+        verses = references.record(verses)
+    for book_verses in group_books(verses):
+        book_chunks = chunk_book(source_name, book_verses, granularities)
+        if counts is not None:
+            counts["verses"] += len(book_verses)
+            counts.update(metadata["granularity"] for _, _, metadata, _ in book_chunks)
+        yield from book_chunks
+
+
+_worker_embeddings = None
+
+
+def _embed_in_worker(texts):
+    global _worker_embeddings
+    if _worker_embeddings is None:
+        import torch
+        torch.set_num_threads(1)  # One process per core already
+        _worker_embeddings = setup_huggingface_embeddings()
+    return _worker_embeddings.embed_documents(texts)
+
+
+class ProcessPoolEmbeddings(Embeddings):
+    """Splits each embed_documents call across a process pool.
+
+    Wrapped by CachedEmbeddings, so only cache misses reach the workers and the
+    disk cache is written by this process alone.
+    """
+
+    def __init__(self, executor, workers):
+        self.executor = executor
+        self.workers = workers
+
+    def embed_documents(self, texts):
+        step = max(1, math.ceil(len(texts) / self.workers))
+        parts = [texts[i:i + step] for i in range(0, len(texts), step)]
+        return [vector for part in self.executor.map(_embed_in_worker, parts) for vector in part]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Qdrant upload
+def ensure_collection(client, embeddings, collection_name=COLLECTION_NAME):
+    """Creates the collection with the same layout as QdrantVectorStore.from_texts, and the filter indexes"""
+    if not client.collection_exists(collection_name):
+        size = len(embeddings.embed_query("dummy_text"))
+        client.create_collection(
+            collection_name,
+            vectors_config={
+                QdrantVectorStore.VECTOR_NAME: models.VectorParams(size=size, distance=models.Distance.COSINE)
+            },
+        )
+    # Keyword indexes for the retriever's granularity/translation filters and the per-source diff
+    for field in ("source", "translation", "granularity"):
+        client.create_payload_index(collection_name, f"{QdrantVectorStore.METADATA_KEY}.{field}",
+                                    field_schema=models.PayloadSchemaType.KEYWORD)
+
+
+def content_hash(text):
+    """SHA-256 of the serialized chunk, stored in the payload to detect changes"""
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
+
+
+def chunk_point_id(source, granularity, chunk, digest):
+    """Content-addressed point ID: the same verses with the same text always map to the same point"""
+    key = f"{source}|{granularity}|{chunk['book']}|{chunk['chapter']}|{chunk['verses']}|{digest}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+
+def chunk_metadata(source, granularity, chunk, digest):
+    """Payload metadata used to filter retrieval and to scope the diff to one source file"""
+    return {
+        "source": source,
+        "translation": translation_name(source),
+        "granularity": granularity,
+        "book": chunk["book"],
+        "chapter": chunk["chapter"],
+        "verses": chunk["verses"],
+        "content_hash": digest,
+    }
+
+
+def existing_point_ids(client, collection_name, source, granularities):
+    """Returns the IDs stored for this source at these granularities.
+
+    Also includes this source's points from before granularities were recorded,
+    and legacy points uploaded without metadata, so both are replaced.
+    """
+    source_key = f"{QdrantVectorStore.METADATA_KEY}.source"
+    granularity_key = f"{QdrantVectorStore.METADATA_KEY}.granularity"
+    this_source = models.FieldCondition(key=source_key, match=models.MatchValue(value=source))
+    filters = [
+        models.Filter(must=[this_source, models.FieldCondition(key=granularity_key,
+                                                               match=models.MatchAny(any=list(granularities)))]),
+        models.Filter(must=[this_source, models.IsEmptyCondition(is_empty=models.PayloadField(key=granularity_key))]),
+        models.Filter(must=[models.IsEmptyCondition(is_empty=models.PayloadField(key=source_key))]),
+    ]
+    ids = set()
+    for scroll_filter in filters:
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                scroll_filter=scroll_filter,
+                limit=1000,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False,
+            )
+            ids.update(point.id for point in points)
+            if offset is None:
+                break
+    return ids
+
+
+def upsert_batch(client, collection_name, ids, texts, metadatas, vectors):
+    """Uploads one embedded batch using QdrantVectorStore's payload layout"""
+    client.upsert(
+        collection_name=collection_name,
+        points=[
+            models.PointStruct(
+                id=point_id,
+                vector={QdrantVectorStore.VECTOR_NAME: vector},
+                payload={
+                    QdrantVectorStore.CONTENT_KEY: text,
+                    QdrantVectorStore.METADATA_KEY: metadata,
+                },
+            )
+            for point_id, text, metadata, vector in zip(ids, texts, metadatas, vectors)
+        ],
+    )
+
+
+def iter_changed_chunks(chunks, existing, seen):
+    """Yields the (id, text, metadata, chunk) tuples not already in the collection, recording every ID in `seen`"""
+    for chunk in chunks:
+        seen.add(chunk[0])
+        if chunk[0] not in existing:
+            yield chunk
+
+
+def index_file(source, client, embeddings, collection_name=COLLECTION_NAME, granularities=None,
+               batch=batch_size, references=None):
+    """Streams a Bible text into Qdrant, embedding only new or changed chunks and deleting stale ones.
+
+    Stale points are only looked for among this source's points at the
+    granularities being indexed, so translations and granularities can be
+    (re)indexed independently. Verses are recorded into `references` if given.
+
+    An interrupted run needs no checkpoint: the chunks it already uploaded keep
+    their IDs and are skipped by the next run's diff.
+    """
+    granularities = granularities or granularity_sizes()
+    ensure_collection(client, embeddings, collection_name)
+    source_name = os.path.basename(source)
+
+    existing = existing_point_ids(client, collection_name, source_name, [name for name, _ in granularities])
+    seen = set()
+
+    total_chunks = 0
+    counts, changed_counts = Counter(), Counter()
+    started = time.perf_counter()
+
+    chunks = iter_source_chunks(source, granularities, references, counts)
+    changed = iter_changed_chunks(chunks, existing, seen)
+    for chunk_batch in batched(changed, batch):
+        ids, texts, metadatas, _ = zip(*chunk_batch)
+        changed_counts.update(metadata["granularity"] for metadata in metadatas)
+
+        embed_start = time.perf_counter()
+        vectors = embeddings.embed_documents(list(texts))
+        embed_time = time.perf_counter() - embed_start
+
+        upsert_start = time.perf_counter()
+        upsert_batch(client, collection_name, ids, texts, metadatas, vectors)
+        upsert_time = time.perf_counter() - upsert_start
+
+        total_chunks += len(chunk_batch)
+        print(f"Batch: {len(chunk_batch)} chunks, embed {embed_time:.2f}s, upsert {upsert_time:.2f}s")
+
+    # Only delete once the whole file has been seen, so an interrupted run never loses points
+    stale = list(existing - seen)
+    for stale_batch in batched(stale, 1000):
+        client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=stale_batch))
+
+    elapsed = time.perf_counter() - started
+    rate = elapsed or 1e-9
+    print(f"{len(seen)} chunks in {source_name}: {total_chunks} new or changed, "
+          f"{len(seen) - total_chunks} unchanged, {len(stale)} stale deleted.")
+    print("Chunks per granularity: " + ", ".join(
+        f"{name} {counts[name]} ({changed_counts[name]} new or changed)" for name, _ in granularities))
+    print(f"Indexed {counts['verses']} verses, {total_chunks} chunks embedded, in {elapsed:.1f}s "
+          f"({counts['verses'] / rate:.1f} verses/s, {total_chunks / rate:.1f} chunks/s)")
+    return total_chunks
+
+
+def save_reference_index(references, source, path=REFERENCE_INDEX_FILE, default=False):
+    """Saves a source's reference index as reference.<translation>.json, and as the default index if asked"""
+    index = references.build()
+    index.save(translation_index_path(path, translation_name(source)))
+    if default:
+        index.save(path)
+
+
+def export_local_index(sources, embeddings, directory=LOCAL_INDEX_DIR, granularities=None, batch=batch_size,
+                       reference_index=REFERENCE_INDEX_FILE):
+    """Writes every chunk of one or more Bible texts into a local index directory for the in-process backend.
+
+    Vectors come through the embedding cache, so exporting after a Qdrant run
+    does not re-embed anything. The BM25 index for hybrid retrieval is built
+    over the chunk texts in the same pass. Each source gets its own reference
+    index, and the first source's is also the default one.
+    """
+    granularities = granularities or granularity_sizes()
+
+    started = time.perf_counter()
+    writer = LocalIndexWriter(directory)
+    lexical_texts = []
+    for i, source in enumerate(sources):
+        references = ReferenceIndexBuilder()
+        chunks = iter_source_chunks(source, granularities, references)
+        for chunk_batch in batched(chunks, batch):
+            ids, texts, metadatas, entries = zip(*chunk_batch)
+            writer.add(ids, texts, metadatas, embeddings.embed_documents(list(texts)))
+            lexical_texts.extend(entry["text"] for entry in entries)
+        save_reference_index(references, source, reference_index, default=i == 0)
+    writer.close()
+    BM25Index.build(lexical_texts).save(directory)
+
+    print(f"Exported {writer.count} chunks to {directory} in {time.perf_counter() - started:.1f}s")
+    return writer.count
+
+
+def setup_embeddings(executor=None, workers=1):
+    """Cached embeddings; with an executor, cache misses are embedded on its worker processes"""
+    if executor is None:
+        return setup_cached_embeddings()
+    return CachedEmbeddings(ProcessPoolEmbeddings(executor, workers), EMBEDDING_MODEL_NAME)
+
+
+def main():
+    """Indexes Bible translations into the Qdrant collection and/or a local index directory"""
+    parser = argparse.ArgumentParser(description="Index Bible translation files into Qdrant and/or a local index.")
+    parser.add_argument("input_files", nargs="*", default=[input_file] if input_file else [],
+                        help="One text file per translation; the file name becomes the translation label")
+    parser.add_argument("--chunk-size", type=int, default=chunk_size, help="Verses per chunk of the window granularity")
+    parser.add_argument("--granularity", nargs="+", choices=list(GRANULARITIES), default=DEFAULT_GRANULARITIES)
+    parser.add_argument("--batch-size", type=int, default=batch_size)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--reference-index", default=REFERENCE_INDEX_FILE,
+                        help="Default index, from the first input file; each file also gets reference.<translation>.json")
+    parser.add_argument("--backend", choices=["qdrant", "local", "both"], default="qdrant",
+                        help="Upload to Qdrant, export a local index directory, or both")
+    parser.add_argument("--local-index", default=LOCAL_INDEX_DIR)
+    args = parser.parse_args()
+    if not args.input_files:
+        parser.error("no input files")
+
+    granularities = granularity_sizes(args.granularity, args.chunk_size)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    # Bigger batches keep every worker busy
+    batch = args.batch_size * max(1, args.workers)
+    try:
+        embeddings = setup_embeddings(executor, args.workers)
+        if args.backend in ("qdrant", "both"):
+            client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY or None)
+            for i, source in enumerate(args.input_files):
+                references = ReferenceIndexBuilder()
+                index_file(source, client, embeddings, collection_name=args.collection, granularities=granularities,
+                           batch=batch, references=references)
+                save_reference_index(references, source, args.reference_index, default=i == 0)
+        if args.backend in ("local", "both"):
+            export_local_index(args.input_files, embeddings, directory=args.local_index, granularities=granularities,
+                               batch=batch, reference_index=args.reference_index)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(f"Embedding cache: {embeddings.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Imports
+import json
+import os
+import re
+from collections import Counter
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from local_index import LOCAL_INDEX_DIR, load_payloads, metadata_mask, top_k
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Reciprocal rank fusion constant (Cormack et al. use 60)
+RRF_K = 60
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted BM25 index with precomputed per-posting weights.
+
+    Postings of term t are doc_ids/weights[offsets[t]:offsets[t + 1]], so a query
+    is a handful of array slices and one np.bincount over the corpus.
+    """
+
+    def __init__(self, vocabulary, offsets, doc_ids, weights, doc_count):
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_count = doc_count
+
+    @classmethod
+    def build(cls, texts, k1=BM25_K1, b=BM25_B):
+        """Builds the index from texts; a document's id is its position in texts"""
+        postings = {}
+        lengths = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        doc_count = len(lengths)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        average_length = float(lengths.mean()) if doc_count else 0.0
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        doc_ids, weights = [], []
+        for i, term in enumerate(vocabulary):
+            ids, tfs = zip(*postings[term])
+            ids = np.asarray(ids, dtype=np.int32)
+            tfs = np.asarray(tfs, dtype=np.float32)
+            idf = np.log(1 + (doc_count - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = k1 * (1 - b + b * lengths[ids] / (average_length or 1.0))
+            doc_ids.append(ids)
+            weights.append((idf * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32))
+            offsets[i + 1] = offsets[i] + len(ids)
+
+        return cls(
+            vocabulary,
+            offsets,
+            np.concatenate(doc_ids) if doc_ids else np.empty(0, np.int32),
+            np.concatenate(weights) if weights else np.empty(0, np.float32),
+            doc_count,
+        )
+
+    def save(self, directory=LOCAL_INDEX_DIR):
+        os.makedirs(directory, exist_ok=True)
+        np.savez(os.path.join(directory, "bm25.npz"), offsets=self.offsets, doc_ids=self.doc_ids,
+                 weights=self.weights, doc_count=np.int64(self.doc_count))
+        with open(os.path.join(directory, "bm25_vocabulary.json"), 'w', encoding='UTF-8') as f:
+            json.dump(self.vocabulary, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory=LOCAL_INDEX_DIR):
+        arrays = np.load(os.path.join(directory, "bm25.npz"))
+        with open(os.path.join(directory, "bm25_vocabulary.json"), 'r', encoding='UTF-8') as f:
+            vocabulary = json.load(f)
+        return cls(vocabulary, arrays["offsets"], arrays["doc_ids"], arrays["weights"], int(arrays["doc_count"]))
+
+    def search(self, query, k=10, mask=None):
+        """Returns [(doc_id, score)] for the k best-scoring documents, only among mask's rows if given"""
+        terms = [self.term_ids[t] for t in set(tokenize(query)) if t in self.term_ids]
+        if not terms:
+            return []
+        slices = [slice(self.offsets[t], self.offsets[t + 1]) for t in terms]
+        scores = np.bincount(np.concatenate([self.doc_ids[s] for s in slices]),
+                             weights=np.concatenate([self.weights[s] for s in slices]),
+                             minlength=self.doc_count)
+        if mask is not None:
+            scores[~mask] = 0.0
+        return [(int(i), float(scores[i])) for i in top_k(scores, k) if scores[i] > 0]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K, with_scores=False):
+    """Fuses ranked lists of (key, item) pairs; returns items ordered by summed 1 / (k + rank)"""
+    scores, items = {}, {}
+    for ranking in rankings:
+        for rank, (key, item) in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            items.setdefault(key, item)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    if with_scores:
+        return [(items[key], scores[key]) for key in ordered]
+    return [items[key] for key in ordered]
+
+
+class HybridRetriever(BaseRetriever):
+    """Runs dense and BM25 retrieval side by side and fuses them by reciprocal rank"""
+
+    dense: BaseRetriever
+    lexical: Any
+    payloads: Any
+    k: int = 2
+    fetch_k: int = 10
+    mask: Any = None  # Rows the BM25 side may return; the dense retriever applies its own filter
+
+    @classmethod
+    def from_directory(cls, dense, directory=LOCAL_INDEX_DIR, metadata_filter=None, **kwargs):
+        """Loads the BM25 index and payload table written by indexer.py"""
+        payloads = load_payloads(directory)
+        mask = metadata_mask(payloads[2], metadata_filter) if metadata_filter else None
+        return cls(dense=dense, lexical=BM25Index.load(directory), payloads=payloads, mask=mask, **kwargs)
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        dense_docs = self.dense.invoke(query, config={"callbacks": run_manager.get_child()})
+        ids, texts, metadatas = self.payloads
+        lexical_docs = [
+            Document(id=ids[i], page_content=texts[i], metadata=metadatas[i])
+            for i, _ in self.lexical.search(query, self.fetch_k, self.mask)
+        ]
+        fused = reciprocal_rank_fusion([
+            [(doc.page_content, doc) for doc in dense_docs],
+            [(doc.page_content, doc) for doc in lexical_docs],
+        ], with_scores=True)
+        return [
+            Document(id=doc.id, page_content=doc.page_content, metadata={**doc.metadata, "score": score})
+            for doc, score in fused[:self.k]
+        ]
@@ -0,0 +1,216 @@
+# Imports
+import json
+import os
+import uuid
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+# Written by indexer.py, loaded by searcher3.py when VECTOR_BACKEND=local
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "bible_index")
+
+
+def normalize_rows(vectors):
+    """L2-normalizes float32 vectors so a dot product is a cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def metadata_mask(metadatas, metadata_filter):
+    """Boolean row mask of the metadatas matching every key/value pair of metadata_filter"""
+    items = list(metadata_filter.items())
+    return np.fromiter((all(metadata.get(key) == value for key, value in items) for metadata in metadatas),
+                       dtype=bool, count=len(metadatas))
+
+
+def load_payloads(directory=LOCAL_INDEX_DIR):
+    """Returns (ids, texts, metadatas) from an index directory's payload table"""
+    ids, texts, metadatas = [], [], []
+    with open(os.path.join(directory, "payloads.jsonl"), 'r', encoding='UTF-8') as f:
+        for line in f:
+            payload = json.loads(line)
+            ids.append(payload["id"])
+            texts.append(payload["page_content"])
+            metadatas.append(payload["metadata"] or {})
+    return ids, texts, metadatas
+
+
+class LocalIndexWriter:
+    """Streams normalized vectors and payloads into an index directory"""
+
+    def __init__(self, directory=LOCAL_INDEX_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.count = 0
+        self.dim = None
+        self._vectors = open(os.path.join(directory, "vectors.f32.tmp"), 'wb')
+        self._payloads = open(os.path.join(directory, "payloads.jsonl.tmp"), 'w', encoding='UTF-8')
+
+    def add(self, ids, texts, metadatas, vectors):
+        vectors = normalize_rows(vectors)
+        self.dim = vectors.shape[1]
+        self._vectors.write(vectors.tobytes())
+        for point_id, text, metadata in zip(ids, texts, metadatas):
+            self._payloads.write(json.dumps({"id": point_id, "page_content": text, "metadata": metadata},
+                                            ensure_ascii=False) + "\n")
+        self.count += len(texts)
+
+    def close(self):
+        """Moves the finished files into place, meta.json last"""
+        self._vectors.close()
+        self._payloads.close()
+        for name in ("vectors.f32", "payloads.jsonl"):
+            path = os.path.join(self.directory, name)
+            os.replace(f"{path}.tmp", path)
+        with open(os.path.join(self.directory, "meta.json"), 'w', encoding='UTF-8') as f:
+            json.dump({"count": self.count, "dim": self.dim}, f)
+
+
+class LocalVectorIndex(VectorStore):
+    """In-process vector store over a memory-mapped float32 matrix, with NumPy top-k and MMR.
+
+    Drop-in for QdrantVectorStore in searcher3.py: as_retriever(search_type="mmr")
+    calls max_marginal_relevance_search below.
+    """
+
+    def __init__(self, embedding, vectors, texts, metadatas=None, ids=None):
+        self.embedding = embedding
+        self.vectors = vectors
+        self.texts = list(texts)
+        self.metadatas = list(metadatas) if metadatas is not None else [{} for _ in self.texts]
+        self.ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in self.texts]
+        self._masks = {}
+
+    @classmethod
+    def load(cls, embedding, directory=LOCAL_INDEX_DIR):
+        """Loads an index directory written by LocalIndexWriter"""
+        with open(os.path.join(directory, "meta.json"), 'r', encoding='UTF-8') as f:
+            meta = json.load(f)
+        vectors = np.memmap(os.path.join(directory, "vectors.f32"), dtype=np.float32, mode='r',
+                            shape=(meta["count"], meta["dim"]))
+        ids, texts, metadatas = load_payloads(directory)
+        return cls(embedding, vectors, texts[:meta["count"]], metadatas[:meta["count"]], ids[:meta["count"]])
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, *, ids=None, **kwargs):
+        texts = list(texts)
+        vectors = normalize_rows(embedding.embed_documents(texts)) if texts else np.empty((0, 0), np.float32)
+        return cls(embedding, vectors, texts, metadatas, ids)
+
+    def add_texts(self, texts, metadatas=None, *, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        vectors = normalize_rows(self.embedding.embed_documents(texts))
+        self.vectors = vectors if self.vectors.size == 0 else np.vstack([self.vectors, vectors])
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas if metadatas is not None else [{} for _ in texts])
+        self.ids.extend(ids)
+        self._masks.clear()
+        return ids
+
+    def _document(self, i, score=None):
+        metadata = self.metadatas[i] if score is None else {**self.metadatas[i], "score": score}
+        return Document(id=self.ids[i], page_content=self.texts[i], metadata=metadata)
+
+    def _scores(self, embedding, filter=None):
+        """Cosine similarities; rows not matching the metadata filter (a dict of equalities) score -inf"""
+        if self.vectors.size == 0:
+            return np.empty(0, dtype=np.float32)
+        scores = self.vectors @ normalize_rows(embedding)[0]
+        if filter:
+            key = tuple(sorted(filter.items()))
+            if key not in self._masks:
+                self._masks[key] = metadata_mask(self.metadatas, filter)
+            scores = np.where(self._masks[key], scores, -np.inf)
+        return scores
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        scores = self._scores(embedding, filter)
+        return [(self._document(i), float(scores[i])) for i in top_k(scores, k) if scores[i] > -np.inf]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k, **kwargs)
+
+    def max_marginal_relevance_search_with_score_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5,
+                                                           filter=None, **kwargs):
+        """[(document, cosine similarity to the query)] in MMR order"""
+        docs = self.max_marginal_relevance_search_by_vector(embedding, k, fetch_k, lambda_mult, filter, **kwargs)
+        return [(doc, doc.metadata["score"]) for doc in docs]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, filter=None,
+                                                **kwargs):
+        scores = self._scores(embedding, filter)
+        candidates = top_k(scores, max(fetch_k, k))
+        candidates = candidates[scores[candidates] > -np.inf]
+        if candidates.size == 0:
+            return []
+        candidate_vectors = np.asarray(self.vectors[candidates])
+        relevance = scores[candidates]
+
+        selected = []
+        redundancy = np.full(candidates.shape[0], -np.inf, dtype=np.float32)
+        for _ in range(min(k, candidates.shape[0])):
+            mmr = relevance if not selected else lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            mmr = np.where(np.isin(np.arange(candidates.shape[0]), selected), -np.inf, mmr)
+            best = int(np.argmax(mmr))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, candidate_vectors @ candidate_vectors[best])
+        # Cosine similarity to the query, for tracing
+        return [self._document(int(candidates[i]), float(relevance[i])) for i in selected]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding.embed_query(query), k, fetch_k, lambda_mult, **kwargs)
+
+
+class ScoredMMRRetriever(BaseRetriever):
+    """MMR retriever that keeps each document's similarity score and ID in its metadata and id.
+
+    Works with LocalVectorIndex and QdrantVectorStore, whose as_retriever() MMR
+    search drops the scores (and, for Qdrant, leaves the point ID in metadata["_id"]).
+    """
+
+    vector_store: Any
+    search_kwargs: dict = {}
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        embedding = self.vector_store.embeddings.embed_query(query)
+        results = self.vector_store.max_marginal_relevance_search_with_score_by_vector(embedding, **self.search_kwargs)
+        docs = []
+        for doc, score in results:
+            doc_id = doc.id if doc.id is not None else doc.metadata.get("_id")
+            docs.append(Document(id=str(doc_id) if doc_id is not None else None, page_content=doc.page_content,
+                                 metadata={**doc.metadata, "score": float(score)}))
+        return docs
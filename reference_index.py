@@ -0,0 +1,343 @@
+# Imports
+import json
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# Written by indexer.py, loaded by searcher3.py
+REFERENCE_INDEX_FILE = os.getenv("REFERENCE_INDEX_FILE", os.path.join("bible_index", "reference.json"))
+
+# Upper bound on verses served for one question, so "Psalm 119" or a long range cannot flood the prompt
+MAX_REFERENCE_VERSES = 200
+
+# Common names and abbreviations per book (protocanonical and deuterocanonical).
+# "Is", "Am" and "Re" are left out: they start ordinary questions such as "Is 3:16 true?"
+BOOK_ALIASES = {
+    "Genesis": ["Gen", "Ge", "Gn"],
+    "Exodus": ["Exod", "Exo", "Ex"],
+    "Leviticus": ["Lev", "Le", "Lv"],
+    "Numbers": ["Num", "Nu", "Nm", "Nb"],
+    "Deuteronomy": ["Deut", "Dt", "De"],
+    "Joshua": ["Josh", "Jos", "Jsh"],
+    "Judges": ["Judg", "Jdg", "Jg"],
+    "Ruth": ["Rth", "Ru"],
+    "1 Samuel": ["1 Sam", "1 Sa", "1Sm", "1 Kingdoms"],
+    "2 Samuel": ["2 Sam", "2 Sa", "2Sm", "2 Kingdoms"],
+    "1 Kings": ["1 Kgs", "1 Ki", "3 Kingdoms"],
+    "2 Kings": ["2 Kgs", "2 Ki", "4 Kingdoms"],
+    "1 Chronicles": ["1 Chron", "1 Chr", "1 Ch", "1 Paralipomenon"],
+    "2 Chronicles": ["2 Chron", "2 Chr", "2 Ch", "2 Paralipomenon"],
+    "Ezra": ["Ezr", "1 Esdras"],
+    "Nehemiah": ["Neh", "Ne", "2 Esdras"],
+    "Tobit": ["Tob", "Tb", "Tobias"],
+    "Judith": ["Jdt", "Jdth"],
+    "Esther": ["Esth", "Est", "Es"],
+    "1 Maccabees": ["1 Macc", "1 Mac", "1 Mc"],
+    "2 Maccabees": ["2 Macc", "2 Mac", "2 Mc"],
+    "Job": ["Jb"],
+    "Psalms": ["Psalm", "Ps", "Psa", "Pss", "Psalter"],
+    "Proverbs": ["Prov", "Pro", "Prv", "Pr"],
+    "Ecclesiastes": ["Eccles", "Eccl", "Ecc", "Qoheleth"],
+    "Song of Solomon": ["Song of Songs", "Song", "Canticles", "Canticle of Canticles", "Sg", "SS"],
+    "Wisdom": ["Wisdom of Solomon", "Wis", "Ws"],
+    "Sirach": ["Sir", "Ecclesiasticus", "Ben Sira"],
+    "Isaiah": ["Isa"],
+    "Jeremiah": ["Jer", "Je", "Jr"],
+    "Lamentations": ["Lam", "La"],
+    "Baruch": ["Bar", "Ba"],
+    "Ezekiel": ["Ezek", "Eze", "Ezk"],
+    "Daniel": ["Dan", "Da", "Dn"],
+    "Hosea": ["Hos", "Ho"],
+    "Joel": ["Jl"],
+    "Amos": [],
+    "Obadiah": ["Obad", "Ob"],
+    "Jonah": ["Jon", "Jnh"],
+    "Micah": ["Mic", "Mc"],
+    "Nahum": ["Nah", "Na"],
+    "Habakkuk": ["Hab", "Hb"],
+    "Zephaniah": ["Zeph", "Zep", "Zp"],
+    "Haggai": ["Hag", "Hg"],
+    "Zechariah": ["Zech", "Zec", "Zc"],
+    "Malachi": ["Mal", "Ml"],
+    "Matthew": ["Matt", "Mat", "Mt"],
+    "Mark": ["Mrk", "Mk", "Mr"],
+    "Luke": ["Luk", "Lk"],
+    "John": ["Jn", "Jhn"],
+    "Acts": ["Acts of the Apostles", "Act", "Ac"],
+    "Romans": ["Rom", "Ro", "Rm"],
+    "1 Corinthians": ["1 Cor", "1 Co"],
+    "2 Corinthians": ["2 Cor", "2 Co"],
+    "Galatians": ["Gal", "Ga"],
+    "Ephesians": ["Eph", "Ephes"],
+    "Philippians": ["Phil", "Php", "Pp"],
+    "Colossians": ["Col", "Co"],
+    "1 Thessalonians": ["1 Thess", "1 Thes", "1 Th"],
+    "2 Thessalonians": ["2 Thess", "2 Thes", "2 Th"],
+    "1 Timothy": ["1 Tim", "1 Ti"],
+    "2 Timothy": ["2 Tim", "2 Ti"],
+    "Titus": ["Tit", "Ti"],
+    "Philemon": ["Philem", "Phm", "Pm"],
+    "Hebrews": ["Heb"],
+    "James": ["Jas", "Jm"],
+    "1 Peter": ["1 Pet", "1 Pe", "1 Pt"],
+    "2 Peter": ["2 Pet", "2 Pe", "2 Pt"],
+    "1 John": ["1 Jn", "1 Jhn", "1 Jo"],
+    "2 John": ["2 Jn", "2 Jhn", "2 Jo"],
+    "3 John": ["3 Jn", "3 Jhn", "3 Jo"],
+    "Jude": ["Jud", "Jd"],
+    "Revelation": ["Revelations", "Rev", "Apocalypse", "Apoc"],
+}
+
+_ORDINALS = {"i": "1", "ii": "2", "iii": "3", "iv": "4", "first": "1", "second": "2", "third": "3", "fourth": "4"}
+
+# "3", "3:16", "3:16-18", "3:16-4:2" or "23-24"
+_NUMBERS_PATTERN = re.compile(
+    r"(?<![\w:])(\d{1,3})(?::(\d{1,3}))?(?:\s*[-–]\s*(\d{1,3})(?::(\d{1,3}))?)?(?![\w:])"
+)
+_WORD_PATTERN = re.compile(r"[^\W_]+")
+_MAX_BOOK_WORDS = 5
+
+
+def normalize_book_name(name):
+    """Lowercase, without punctuation or spaces, with roman/word ordinals turned into digits"""
+    words = _WORD_PATTERN.findall(name.lower())
+    if len(words) > 1 and words[0] in _ORDINALS:
+        words[0] = _ORDINALS[words[0]]
+    return "".join(words)
+
+
+def reference_book(text, match, resolve_book):
+    """Book named right before a _NUMBERS_PATTERN match, as resolved by resolve_book(name), or None.
+
+    Chapter-only references ("Psalm 23") and abbreviations of two letters or fewer
+    ("Ex 20:3") require a capitalized book name, so that phrases like "my job 3 times"
+    or "what de 3:16 means" are not mistaken for scripture.
+    """
+    prefix = text[max(0, match.start() - 40):match.start()]
+    if not prefix.endswith((" ", ".", " ")):
+        return None
+    words = _WORD_PATTERN.findall(prefix)[-_MAX_BOOK_WORDS:]
+    for n in range(len(words), 0, -1):
+        book_id = resolve_book(" ".join(words[-n:]))
+        if book_id is not None:
+            break
+    else:
+        return None
+    if (match.group(2) is None or len(words[-1]) <= 2) and not words[-1][:1].isupper():
+        return None
+    return book_id
+
+
+_BOOK_NAMES = {normalize_book_name(name): canonical
+               for canonical, aliases in BOOK_ALIASES.items() for name in [canonical] + aliases}
+
+
+def contains_reference(text):
+    """True if text cites a passage ("John 3:16", "Psalm 23"), without needing a reference index"""
+    resolve = lambda name: _BOOK_NAMES.get(normalize_book_name(name))  # noqa: E731
+    return any(reference_book(text, match, resolve) is not None for match in _NUMBERS_PATTERN.finditer(text))
+
+
+class ReferenceIndex:
+    """Array-backed book -> chapter -> verse index.
+
+    Chapters of book b are chapter_numbers[book_chapters[b]:book_chapters[b + 1]],
+    and verses of chapter c are verse_numbers/texts[chapter_verses[c]:chapter_verses[c + 1]].
+    """
+
+    def __init__(self, books, book_chapters, chapter_numbers, chapter_verses, verse_numbers, texts):
+        self.books = books
+        self.book_chapters = array('I', book_chapters)
+        self.chapter_numbers = array('H', chapter_numbers)
+        self.chapter_verses = array('I', chapter_verses)
+        self.verse_numbers = array('H', verse_numbers)
+        self.texts = texts
+        self.book_ids = self._build_aliases()
+
+    def _build_aliases(self):
+        book_ids = {normalize_book_name(book): i for i, book in enumerate(self.books)}
+        for canonical, aliases in BOOK_ALIASES.items():
+            names = [canonical] + aliases
+            book_id = next((book_ids[normalize_book_name(n)] for n in names if normalize_book_name(n) in book_ids), None)
+            if book_id is None:
+                continue
+            for name in names:
+                book_ids.setdefault(normalize_book_name(name), book_id)
+        return book_ids
+
+    @classmethod
+    def load(cls, path=REFERENCE_INDEX_FILE):
+        with open(path, 'r', encoding='UTF-8') as f:
+            data = json.load(f)
+        return cls(**data)
+
+    def save(self, path=REFERENCE_INDEX_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data = {
+            "books": self.books,
+            "book_chapters": self.book_chapters.tolist(),
+            "chapter_numbers": self.chapter_numbers.tolist(),
+            "chapter_verses": self.chapter_verses.tolist(),
+            "verse_numbers": self.verse_numbers.tolist(),
+            "texts": self.texts,
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def resolve_book(self, name):
+        """Returns the book id for a name or alias, or None"""
+        return self.book_ids.get(normalize_book_name(name))
+
+    def _chapter_index(self, book_id, chapter):
+        lo, hi = self.book_chapters[book_id], self.book_chapters[book_id + 1]
+        i = bisect_left(self.chapter_numbers, chapter, lo, hi)
+        return i if i < hi and self.chapter_numbers[i] == chapter else None
+
+    def verses(self, book_id, chapter, verse_start=None, chapter_end=None, verse_end=None):
+        """Returns [(book, chapter, verse, text)] for a chapter, verse or range; empty if it does not exist"""
+        chapter_end = chapter_end or chapter
+        first = self._chapter_index(book_id, chapter)
+        last = self._chapter_index(book_id, chapter_end)
+        if first is None or last is None or last < first:
+            return []
+
+        lo = self.chapter_verses[first]
+        if verse_start is not None:
+            lo = bisect_left(self.verse_numbers, verse_start, lo, self.chapter_verses[first + 1])
+        hi = self.chapter_verses[last + 1]
+        if verse_end is not None:
+            hi = bisect_right(self.verse_numbers, verse_end, self.chapter_verses[last], hi)
+        hi = min(hi, lo + MAX_REFERENCE_VERSES)
+
+        book = self.books[book_id]
+        result = []
+        for c in range(first, last + 1):
+            start, end = max(self.chapter_verses[c], lo), min(self.chapter_verses[c + 1], hi)
+            result.extend((book, self.chapter_numbers[c], self.verse_numbers[i], self.texts[i]) for i in range(start, end))
+        return result
+
+    def find_references(self, text):
+        """Yields (book_id, chapter, verse_start, chapter_end, verse_end) for each reference in text"""
+        for match in _NUMBERS_PATTERN.finditer(text):
+            book_id = reference_book(text, match, self.resolve_book)
+            if book_id is None:
+                continue
+            chapter, verse_start, range_a, range_b = match.groups()
+            chapter = int(chapter)
+            if verse_start is None:
+                # "23" or a chapter range "23-24"
+                yield book_id, chapter, None, int(range_a) if range_a else None, None
+            elif range_b is not None:
+                # "3:16-4:2"
+                yield book_id, chapter, int(verse_start), int(range_a), int(range_b)
+            elif range_a is not None:
+                # "3:16-18"
+                yield book_id, chapter, int(verse_start), None, int(range_a)
+            else:
+                yield book_id, chapter, int(verse_start), None, int(verse_start)
+
+    def find_passages(self, text):
+        """Returns [(label, verses)] for every reference in text that exists in the index"""
+        passages = []
+        for book_id, chapter, verse_start, chapter_end, verse_end in self.find_references(text):
+            verses = self.verses(book_id, chapter, verse_start, chapter_end, verse_end)
+            if verses:
+                passages.append((format_reference(verses), verses))
+        return passages
+
+
+def format_reference(verses):
+    """Label like "John 3:16-18" or "John 3:16-4:2" for a contiguous list of verses"""
+    book, chapter, verse, _ = verses[0]
+    _, last_chapter, last_verse, _ = verses[-1]
+    if (chapter, verse) == (last_chapter, last_verse):
+        return f"{book} {chapter}:{verse}"
+    if chapter == last_chapter:
+        return f"{book} {chapter}:{verse}-{last_verse}"
+    return f"{book} {chapter}:{verse}-{last_chapter}:{last_verse}"
+
+
+class ReferenceIndexBuilder:
+    """Collects (book, chapter, verse, text) tuples in reading order into a ReferenceIndex"""
+
+    def __init__(self):
+        self.books = []
+        self.book_chapters = [0]
+        self.chapter_numbers = []
+        self.chapter_verses = [0]
+        self.verse_numbers = []
+        self.texts = []
+        self._current = None
+
+    def add(self, book, chapter, verse, text):
+        if self._current is None or self._current[0] != book:
+            if self._current is not None:
+                self._close_chapter()
+                self.book_chapters.append(len(self.chapter_numbers))
+            self.books.append(book)
+            self._current = (book, None)
+        if self._current[1] != chapter:
+            if self._current[1] is not None:
+                self._close_chapter()
+            self.chapter_numbers.append(chapter)
+            self._current = (book, chapter)
+        self.verse_numbers.append(verse)
+        self.texts.append(text)
+
+    def _close_chapter(self):
+        self.chapter_verses.append(len(self.verse_numbers))
+
+    def record(self, verses):
+        """Passes verses through unchanged while adding them to the index"""
+        for verse in verses:
+            self.add(*verse)
+            yield verse
+
+    def build(self):
+        book_chapters, chapter_verses = list(self.book_chapters), list(self.chapter_verses)
+        if self._current is not None:
+            chapter_verses.append(len(self.verse_numbers))
+            book_chapters.append(len(self.chapter_numbers))
+        return ReferenceIndex(self.books, book_chapters, self.chapter_numbers, chapter_verses,
+                              self.verse_numbers, self.texts)
+
+
+class ReferenceRetriever(BaseRetriever):
+    """Serves cited verses straight from the reference index, falling back to semantic search"""
+
+    index: Any
+    fallback: BaseRetriever
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        passages = self.index.find_passages(query)
+        if not passages:
+            return self.fallback.invoke(query, config={"callbacks": run_manager.get_child()})
+        return [
+            Document(
+                page_content="\n".join(f"{book} {chapter}:{verse} {text}" for book, chapter, verse, text in verses),
+                metadata={"source": "reference", "reference": label, "passage": verses},
+            )
+            for label, verses in passages
+        ]
+
+
+def translation_index_path(path, translation):
+    """Reference index of one translation, next to the default one: reference.json -> reference.<translation>.json"""
+    if not translation:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}.{translation}{extension}"
+
+
+def with_reference_fast_path(retriever, path=REFERENCE_INDEX_FILE):
+    """Wraps a retriever with the reference fast path if the index file exists"""
+    if not os.path.exists(path):
+        return retriever
+    return ReferenceRetriever(index=ReferenceIndex.load(path), fallback=retriever)
@@ -0,0 +1,141 @@
+# Imports
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from local_index import normalize_rows
+from telemetry import record_cache
+
+# Off by default: a cached answer is reused for any question phrased closely enough
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+# Minimum cosine similarity between query embeddings for a hit
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+# Entries kept per chain, least recently used evicted first
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+
+
+def chain_key(religion, conv_type):
+    return religion.value, conv_type.value
+
+
+class CachedResponse:
+    """A stored first-turn answer, its sources and what it cost to produce"""
+
+    def __init__(self, query, vector, answer, sources, seconds):
+        self.id = None
+        self.query = query
+        self.vector = vector
+        self.answer = answer
+        self.sources = sources
+        self.seconds = seconds
+        self.created = time.monotonic()
+
+
+class ResponseCacheStats:
+    """Lookups, hits and the generation time the hits avoided"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.seconds_saved = 0.0
+
+    def record(self, outcome, seconds_saved=0.0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.seconds_saved += seconds_saved
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "seconds_saved": round(self.seconds_saved, 3),
+            }
+
+
+class SemanticResponseCache:
+    """First-turn answers per (religion, conversation type), matched by query embedding similarity.
+
+    Only questions asked without chat history are looked up or stored, since
+    history can change the answer. Entries expire after ttl_seconds.
+    """
+
+    def __init__(self, embed_query, threshold=RESPONSE_CACHE_THRESHOLD, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries=RESPONSE_CACHE_SIZE):
+        self.embed_query = embed_query
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = ResponseCacheStats()
+        self._chains = {}  # chain key -> OrderedDict of entries, least recently used first
+        self._matrices = {}  # chain key -> stacked entry vectors, rebuilt after changes
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._chains.values())
+
+    def lookup(self, key, query, chat_history=None):
+        """Returns (entry or None, query vector); (None, None) when chat history bypasses the cache"""
+        if chat_history:
+            self.stats.record("bypassed")
+            return None, None
+        started = time.perf_counter()
+        vector = normalize_rows(self.embed_query(query))[0]
+        with self._lock:
+            entries = self._chains.get(key)
+            entry = self._best_match(key, entries, vector) if entries else None
+            if entry is not None:
+                entries.move_to_end(entry.id)
+        record_cache("response", entry is not None)
+        if entry is None:
+            self.stats.record("misses")
+        else:
+            self.stats.record("hits", max(0.0, entry.seconds - (time.perf_counter() - started)))
+        return entry, vector
+
+    def _best_match(self, key, entries, vector):
+        expired = [entry_id for entry_id, entry in entries.items()
+                   if time.monotonic() - entry.created > self.ttl_seconds]
+        for entry_id in expired:
+            del entries[entry_id]
+        if expired:
+            self._matrices.pop(key, None)
+        if not entries:
+            return None
+        matrix = self._matrices.get(key)
+        if matrix is None:
+            matrix = self._matrices[key] = (list(entries.values()), np.stack([e.vector for e in entries.values()]))
+        candidates, vectors = matrix
+        scores = vectors @ vector
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.threshold else None
+
+    def store(self, key, query, vector, answer, sources=(), seconds=0.0):
+        """Stores a first-turn answer; vector is the one returned by lookup()"""
+        if vector is None or not answer:
+            return
+        entry = CachedResponse(query, vector, answer, list(sources), seconds)
+        with self._lock:
+            entry.id = next(self._ids)
+            entries = self._chains.setdefault(key, OrderedDict())
+            entries[entry.id] = entry
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._matrices.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._chains.clear()
+            self._matrices.clear()
@@ -1,15 +1,32 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+import logging
 import os
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
 from enum import Enum
-from langchain_qdrant import QdrantVectorStore
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_google_vertexai import VertexAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import ConversationalRetrievalChain, LLMChain
-from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.prompts import PromptTemplate
+# langchain, qdrant, vertexai, the embedding model and this repo's retrieval modules are
+# imported inside the functions that use them, so the menu appears before they load.
+
+logger = logging.getLogger(__name__)
 
 # environment variables for sensitive info
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
+# "qdrant" for the remote collection, "local" for the in-process index written by indexer.py --backend local
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+# "dense" for MMR only, "hybrid" to fuse MMR with the BM25 index in LOCAL_INDEX_DIR
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+# Restrict retrieval to one chunk granularity ("verse", "window", "chapter") and/or translation; empty for all
+RETRIEVAL_GRANULARITY = os.getenv("RETRIEVAL_GRANULARITY", "")
+RETRIEVAL_TRANSLATION = os.getenv("RETRIEVAL_TRANSLATION", "")
+# Build chains on first use and warm up the embedding model while the user is in the menu
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "1") == "1"
+# Print the per-phase startup breakdown
+SHOW_STARTUP_TIMINGS = os.getenv("STARTUP_TIMINGS", "0") == "1"
 
 class Religion(Enum):
     CATHOLICISM = "Catholicism"
@@ -22,35 +39,87 @@ class ConversationType(Enum):
     CONFESSION = "Confession"
     MEDITATION = "Meditation"
 
+def enum_member(enum_type, value):
+    """Accepts an enum member's name or value, case-insensitively"""
+    for member in enum_type:
+        if value.lower() in (member.name.lower(), member.value.lower()):
+            return member
+    raise ValueError(f"Unknown {enum_type.__name__}: {value}")
+
 
 # Embeddings and Vector Store Setup
-def setup_embeddings_and_vector_store():
-    """Sets up HuggingFace embeddings and Qdrant vector store"""
-    model_name = 'sentence-transformers/all-MiniLM-L6-v2'
-    model_kwargs = {'device': 'cpu'}
-    encode_kwargs = {'normalize_embeddings': False}
-    embeddings = HuggingFaceEmbeddings(
-        model_name=model_name,
-        model_kwargs=model_kwargs,
-        encode_kwargs=encode_kwargs
-    )
-    vector_store_bible = QdrantVectorStore.from_existing_collection(
-        embedding=embeddings,
-        collection_name="Bible Chunks",
-        url=QDRANT_URL,
-        api_key=QDRANT_API_KEY,
-    )
-    return vector_store_bible.as_retriever(search_type="mmr", search_kwargs={"k": 2})
+def setup_embeddings_and_vector_store(embeddings=None):
+    """Sets up cached HuggingFace embeddings, the Qdrant (or local) vector store and the retriever wrappers"""
+    from embedding_cache import setup_cached_embeddings
+    from local_index import LOCAL_INDEX_DIR, LocalVectorIndex
+
+    # Pass the embeddings in to share one model and cache with the response cache
+    embeddings = embeddings or setup_cached_embeddings()
+    if VECTOR_BACKEND == "local":
+        vector_store_bible = LocalVectorIndex.load(embeddings, LOCAL_INDEX_DIR)
+    else:
+        from langchain_qdrant import QdrantVectorStore
+        vector_store_bible = QdrantVectorStore.from_existing_collection(
+            embedding=embeddings,
+            collection_name="Bible Chunks",
+            url=QDRANT_URL,
+            api_key=QDRANT_API_KEY,
+        )
+    return setup_retriever(vector_store_bible, metadata_filter=retrieval_filter())
+
+
+def retrieval_filter(granularity=RETRIEVAL_GRANULARITY, translation=RETRIEVAL_TRANSLATION):
+    """Chunk metadata the retriever is restricted to, as a dict of equalities"""
+    metadata_filter = {"granularity": granularity, "translation": translation}
+    return {key: value for key, value in metadata_filter.items() if value}
+
+
+def search_filter(vector_store, metadata_filter):
+    """Converts a dict of metadata equalities into the vector store's filter format"""
+    from local_index import LocalVectorIndex
+    if not metadata_filter or isinstance(vector_store, LocalVectorIndex):
+        return metadata_filter or None
+    from qdrant_client import models
+    return models.Filter(must=[
+        models.FieldCondition(key=f"{vector_store.metadata_payload_key}.{key}", match=models.MatchValue(value=value))
+        for key, value in metadata_filter.items()
+    ])
+
+
+def setup_retriever(vector_store, retrieval_mode=RETRIEVAL_MODE, index_dir=None, reference_index=None,
+                    metadata_filter=None):
+    """Wraps a vector store with hybrid search, the reference fast path and context compaction"""
+    from context_format import CompactContextRetriever
+    from lexical_index import HybridRetriever
+    from local_index import LOCAL_INDEX_DIR, ScoredMMRRetriever
+    from reference_index import REFERENCE_INDEX_FILE, translation_index_path, with_reference_fast_path
+
+    native_filter = search_filter(vector_store, metadata_filter)
+    filter_kwargs = {"filter": native_filter} if native_filter else {}
+    if retrieval_mode == "hybrid":
+        dense = ScoredMMRRetriever(vector_store=vector_store, search_kwargs={"k": 10, **filter_kwargs})
+        retriever = HybridRetriever.from_directory(dense, index_dir or LOCAL_INDEX_DIR, metadata_filter=metadata_filter,
+                                                   k=2, fetch_k=10)
+    else:
+        # Keeps similarity scores and chunk IDs for tracing, which as_retriever()'s MMR search drops
+        retriever = ScoredMMRRetriever(vector_store=vector_store, search_kwargs={"k": 2, **filter_kwargs})
+    # Cited verses come from the same translation that retrieval is restricted to
+    reference_index = translation_index_path(reference_index or REFERENCE_INDEX_FILE,
+                                             (metadata_filter or {}).get("translation"))
+    # Prompts get compact "Book C:V text" lines, deduplicated and capped at CONTEXT_TOKEN_BUDGET
+    return CompactContextRetriever(retriever=with_reference_fast_path(retriever, reference_index))
 
 
 # LLM Setup
-def setup_llm():
+def setup_llm(streaming=True):
     """Sets up the VertexAI LLM"""
+    from langchain_google_vertexai import VertexAI
     return VertexAI(
         model_name="gemini-2.5-flash-preview-04-17",
         max_output_tokens=50000,
         temperature=0.2,
-        top_p=0.8
+        top_p=0.8,
+        streaming=streaming  # Emits tokens to callbacks as they are generated
     )
 
 
@@ -164,12 +233,13 @@ Respond in markdown, in the input's language, with a clear, calm, and respectful
 Do not mention the version of the Bible you are using.
 {structure_template}
 """
-    return PromptTemplate(input_variables=["chat_history", "question", "context", "values"], template=full_template)
+    return PromptTemplate(input_variables=["chat_history", "question", "context"], template=full_template,
+                          partial_variables={"values": values})
 
 def create_meditation_prompt_template(denomination):
     """Creates a PromptTemplate for meditation roles."""
     return PromptTemplate(input_variables=["question", "denomination"],
-                          template=BASE_MEDITATION_PROMPT.format(denomination=denomination))
+                          template=BASE_MEDITATION_PROMPT.format(denomination=denomination, question="{question}"))
 
 # Define specific prompt instances
 prompt_bible_coach_catholic = create_prompt_template(
@@ -218,9 +288,41 @@ prompt_meditation_catholic = create_meditation_prompt_template("Catholic")
 prompt_meditation_orthodox = create_meditation_prompt_template("Christian Orthodox")
 prompt_meditation_protestantism = create_meditation_prompt_template("Christian Protestant")
 
+# Prompt of each available chain
+CHAIN_PROMPTS = {
+    Religion.CATHOLICISM: {
+        ConversationType.BIBLE_COACH: prompt_bible_coach_catholic,
+        ConversationType.PRAYER_HELP: prompt_prayer_help_catholic,
+        ConversationType.CONFESSION: prompt_confession_catholic,
+        ConversationType.MEDITATION: prompt_meditation_catholic
+    },
+    Religion.ORTHODOX: {
+        ConversationType.BIBLE_COACH: prompt_bible_coach_orthodox,
+        ConversationType.PRAYER_HELP: prompt_prayer_help_orthodox,
+        ConversationType.CONFESSION: prompt_confession_orthodox,
+        ConversationType.MEDITATION: prompt_meditation_orthodox
+    },
+    Religion.PROTESTANTISM: {
+        ConversationType.BIBLE_COACH: prompt_bible_coach_protestantism,
+        ConversationType.PRAYER_HELP: prompt_prayer_help_protestantism,
+        # Protestantism typically does not have formal sacramental confession as in Catholicism/Orthodoxy
+        ConversationType.MEDITATION: prompt_meditation_protestantism
+    }
+}
+
 # Memory Setup
-def setup_memory():
-    """Sets up ConversationBufferWindowMemory."""
+def setup_memory(llm=None):
+    """Sets up token-budgeted summarizing memory, or ConversationBufferWindowMemory without an llm."""
+    if llm is not None:
+        from summary_memory import SummarizingTokenBufferMemory
+
+        return SummarizingTokenBufferMemory(
+            llm=llm,
+            memory_key="chat_history",
+            input_key="question",
+            return_messages=True
+        )
+    from langchain.memory import ConversationBufferWindowMemory
     return ConversationBufferWindowMemory(
         memory_key="chat_history",
         input_key="question",
@@ -229,59 +331,202 @@ def setup_memory():
     )
 
 # Chain Initialization
-def initialize_chains(llm, retriever, memory):
-    """Initializes and returns a dictionary of all conversation chains"""
-    chains = {
-        Religion.CATHOLICISM: {
-            ConversationType.BIBLE_COACH: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_bible_coach_catholic}
-            ),
-            ConversationType.PRAYER_HELP: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_prayer_help_catholic}
-            ),
-            ConversationType.CONFESSION: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_confession_catholic}
-            ),
-            ConversationType.MEDITATION: LLMChain(llm=llm, memory=memory, prompt=prompt_meditation_catholic)
-        },
-        Religion.ORTHODOX: {
-            ConversationType.BIBLE_COACH: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_bible_coach_orthodox}
-            ),
-            ConversationType.PRAYER_HELP: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_prayer_help_orthodox}
-            ),
-            ConversationType.CONFESSION: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_confession_orthodox}
-            ),
-            ConversationType.MEDITATION: LLMChain(llm=llm, memory=memory, prompt=prompt_meditation_orthodox)
-        },
-        Religion.PROTESTANTISM: {
-            ConversationType.BIBLE_COACH: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_bible_coach_protestantism}
-            ),
-            ConversationType.PRAYER_HELP: ConversationalRetrievalChain.from_llm(
-                llm=llm, retriever=retriever, memory=memory,
-                combine_docs_chain_kwargs={"prompt": prompt_prayer_help_protestantism}
-            ),
-            # Protestantism typically does not have formal sacramental confession as in Catholicism/Orthodoxy
-            ConversationType.MEDITATION: LLMChain(llm=llm, memory=memory, prompt=prompt_meditation_protestantism)
-        }
+def retrieval_chain(llm, retriever, memory, prompt):
+    """Builds a ConversationalRetrievalChain whose answer step is tagged for token streaming"""
+    from langchain.chains import ConversationalRetrievalChain
+    from condense import CondenseQuestionChain
+    from streaming import ANSWER_TAG
+    chain = ConversationalRetrievalChain.from_llm(
+        llm=llm, retriever=retriever, memory=memory,
+        combine_docs_chain_kwargs={"prompt": prompt, "tags": [ANSWER_TAG]}
+    )
+    # Skip the question-condensing LLM call unless CONDENSE_STRATEGY says it is needed
+    chain.question_generator = CondenseQuestionChain(llm_chain=chain.question_generator)
+    return chain
+
+def meditation_chain(llm, memory, prompt):
+    """Builds the meditation LLMChain, tagged for token streaming"""
+    from langchain.chains import LLMChain
+    from streaming import ANSWER_TAG
+    return LLMChain(llm=llm, memory=memory, prompt=prompt, tags=[ANSWER_TAG])
+
+def build_chain(llm, retriever, memory, religion, conv_type):
+    """Builds the chain for one (Religion, ConversationType) pair"""
+    prompt = CHAIN_PROMPTS[religion][conv_type]
+    if conv_type == ConversationType.MEDITATION:
+        return meditation_chain(llm, memory, prompt)
+    return retrieval_chain(llm, retriever, memory, prompt)
+
+def initialize_chains(llm, retriever, memory=None):
+    """Initializes and returns a dictionary of all conversation chains.
+
+    With memory=None the chains are stateless and can be shared between sessions;
+    callers then pass each session's chat history to invoke_chain.
+    """
+    return {
+        religion: {conv_type: build_chain(llm, retriever, memory, religion, conv_type) for conv_type in prompts}
+        for religion, prompts in CHAIN_PROMPTS.items()
     }
-    return chains
+
+# Lazy Startup
+class StartupTimer:
+    """Wall-clock breakdown of startup phases"""
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = []
+        self.reported = False
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self):
+        with self._lock:
+            phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        return f"Startup: {phases} (total {time.perf_counter() - self.started:.2f}s since import)"
+
+STARTUP = StartupTimer(_IMPORT_STARTED)
+STARTUP.record("imports", time.perf_counter() - _IMPORT_STARTED)
+
+class LazyComponents:
+    """LLM, retriever and memory shared by the chains, each created on first use"""
+
+    def __init__(self, timer=STARTUP):
+        self.timer = timer
+        self._values = {}
+        self._locks = {name: threading.Lock() for name in ("llm", "embeddings", "retriever", "memory")}
+
+    def _get(self, name, factory, phase):
+        with self._locks[name]:
+            if name not in self._values:
+                with self.timer.phase(phase):
+                    self._values[name] = factory()
+            return self._values[name]
+
+    @property
+    def llm(self):
+        return self._get("llm", setup_llm, "llm")
+
+    @property
+    def embeddings(self):
+        from embedding_cache import setup_cached_embeddings
+        return self._get("embeddings", setup_cached_embeddings, "embeddings")
+
+    @property
+    def retriever(self):
+        return self._get("retriever", lambda: setup_embeddings_and_vector_store(self.embeddings), "vector store")
+
+    @property
+    def memory(self):
+        return self._get("memory", lambda: setup_memory(self.llm), "memory")
+
+    def warm_up_in_background(self):
+        """Loads the embedding model and vector store while the user is still choosing in the menu"""
+        def warm_up():
+            try:
+                self.retriever
+            except Exception:
+                # Raised again when the first chain needs the retriever
+                logger.warning("Warm-up failed", exc_info=True)
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+class LazyChainGroup(Mapping):
+    """The chains of one religion, each built on first access"""
+
+    def __init__(self, components, religion):
+        self.components = components
+        self.religion = religion
+        self.chains = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, conv_type):
+        if conv_type not in CHAIN_PROMPTS[self.religion]:
+            raise KeyError(conv_type)
+        with self._lock:
+            if conv_type not in self.chains:
+                components = self.components
+                # Meditation does not retrieve, so it does not wait for the embedding model
+                retriever = None if conv_type == ConversationType.MEDITATION else components.retriever
+                llm, memory = components.llm, components.memory
+                with components.timer.phase(f"chain {self.religion.value} / {conv_type.value}"):
+                    self.chains[conv_type] = build_chain(llm, retriever, memory, self.religion, conv_type)
+            return self.chains[conv_type]
+
+    def __contains__(self, conv_type):
+        # Mapping's default calls __getitem__, which would build the chain
+        return conv_type in CHAIN_PROMPTS[self.religion]
+
+    def __iter__(self):
+        return iter(CHAIN_PROMPTS[self.religion])
+
+    def __len__(self):
+        return len(CHAIN_PROMPTS[self.religion])
+
+class LazyChains(Mapping):
+    """Same shape as initialize_chains()'s dictionary, but chains are built on first use"""
+
+    def __init__(self, components):
+        self.groups = {religion: LazyChainGroup(components, religion) for religion in CHAIN_PROMPTS}
+
+    def __getitem__(self, religion):
+        return self.groups[religion]
+
+    def __contains__(self, religion):
+        return religion in self.groups
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+def invoke_chain(chain, religion, query, chat_history=None, callbacks=None, conv_type=None):
+    """Runs one traced turn against a chain and returns the answer text"""
+    from langchain.chains import LLMChain
+    from telemetry import TelemetryHandler, trace_turn
+
+    with trace_turn(religion=religion.value, conversation_type=conv_type.value if conv_type else None) as trace:
+        config = {"callbacks": list(callbacks or []) + [TelemetryHandler(trace)]}
+        # Determine if it's an LLMChain (meditation) or ConversationalRetrievalChain (the rest)
+        if isinstance(chain, LLMChain):
+            response = chain.invoke({"question": query, "denomination": religion.value},  # Pass denomination for meditation
+                                    config=config)
+            return response['text']  # LLMChain returns 'text'
+        inputs = {"question": query}
+        if chat_history is not None:
+            inputs["chat_history"] = chat_history
+        response = chain.invoke(inputs, config=config)
+        return response['answer']  # ConversationalRetrievalChain returns 'answer'
 
 # Main Application Logic
-def run_conversation(selected_religion, selected_conv_type, chains):
+def run_conversation(selected_religion, selected_conv_type, chains, response_cache=None):
     """Handles the actual conversation flow"""
+    from streaming import source_label, stream_turn
+
     print(f"{selected_conv_type.value} selected.\n\n")
     current_chain = chains[selected_religion][selected_conv_type]
+    if SHOW_STARTUP_TIMINGS and not STARTUP.reported:
+        STARTUP.reported = True
+        print(STARTUP.report())
+    # Every chain shares one memory, so a new conversation must not inherit the previous one's history
+    memory = current_chain.memory
+    if memory:
+        memory.clear()
+    cache_key = (selected_religion.value, selected_conv_type.value)
+
+    def print_sources(sources):
+        if sources:
+            print(f"Sources: {'; '.join(source_label(doc) for doc in sources)}\n")
 
     while True:
         query = input("\nYou: ")
@@ -289,27 +534,66 @@ def run_conversation(selected_religion, selected_conv_type, chains):
             print("Exiting conversation. Goodbye!")
             break
         try:
-            # Determine if it's an LLMChain (meditation) or ConversationalRetrievalChain (the rest)
-            if isinstance(current_chain, LLMChain):
-                response = current_chain.invoke(
-                    {"question": query, "denomination": selected_religion.value})  # Pass denomination for meditation
-                print(response['text'])  # LLMChain returns 'text'
-            else:
-                response = current_chain.invoke({"question": query})
-                print(response['answer'])  # ConversationalRetrievalChain returns 'answer'
+            # Only first-turn questions can be answered from the response cache
+            cached = vector = None
+            if response_cache is not None:
+                chat_history = memory.load_memory_variables({})[memory.memory_key] if memory else None
+                cached, vector = response_cache.lookup(cache_key, query, chat_history)
+            if cached is not None:
+                print_sources(cached.sources)
+                print(cached.answer)
+                if memory:
+                    memory.save_context({"question": query}, {"answer": cached.answer})
+                continue
+
+            # Stream the answer as it is generated, after listing the retrieved passages
+            events = stream_turn(
+                lambda callbacks: invoke_chain(current_chain, selected_religion, query, callbacks=callbacks,
+                                               conv_type=selected_conv_type))
+            sources = answer = None
+            for kind, payload in events:
+                if kind == "sources" and payload:
+                    sources = payload
+                    print_sources(payload)
+                elif kind == "token":
+                    print(payload, end="", flush=True)
+                elif kind == "done":
+                    answer = payload
+                elif kind == "metrics" and vector is not None:
+                    response_cache.store(cache_key, query, vector, answer, sources or (), payload.as_dict()["total_time"])
+            print()
         except Exception as e:
-            print(f"An error occurred: {e}")
+            logger.exception("Turn failed (%s, %s)", selected_religion.value, selected_conv_type.value)
+            print(f"\nAn error occurred: {e}")
             print("Please try again or type 'exit' to quit.")
 
 
 def main():
     """Main function to run the religious app"""
+    # Per-turn traces are logged at INFO; LOG_LEVEL=INFO shows them, LOG_FILE keeps them out of the chat
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"), filename=os.getenv("LOG_FILE"))
     print("Welcome to the religion app.")
 
-    retriever_bible = setup_embeddings_and_vector_store()
-    llm = setup_llm()
-    memory = setup_memory()
-    chains = initialize_chains(llm, retriever_bible, memory)
+    if LAZY_STARTUP:
+        components = LazyComponents()
+        components.warm_up_in_background()
+        chains = LazyChains(components)
+        embed_query = lambda text: components.embeddings.embed_query(text)  # noqa: E731
+    else:
+        from embedding_cache import setup_cached_embeddings
+        with STARTUP.phase("embeddings + vector store"):
+            embeddings = setup_cached_embeddings()
+            retriever_bible = setup_embeddings_and_vector_store(embeddings)
+        with STARTUP.phase("llm"):
+            llm = setup_llm()
+        memory = setup_memory(llm)
+        with STARTUP.phase("chains"):
+            chains = initialize_chains(llm, retriever_bible, memory)
+        embed_query = embeddings.embed_query
+
+    from response_cache import RESPONSE_CACHE_ENABLED, SemanticResponseCache
+    response_cache = SemanticResponseCache(embed_query) if RESPONSE_CACHE_ENABLED else None
+    STARTUP.record("time to menu", time.perf_counter() - STARTUP.started)
 
     while True:
         print("\nPlease select the type of Christianity you want to talk about:")
@@ -349,10 +633,12 @@ def main():
             print("Invalid option. Please select a valid conversation type.")
             continue
 
-        run_conversation(selected_religion, selected_conv_type, chains)
+        run_conversation(selected_religion, selected_conv_type, chains, response_cache)
 
         # Option to go back to main menu or exit
         if input("\nDo you want to start a new conversation? (yes/no): ").lower() != 'yes':
+            if response_cache is not None:
+                print(f"Response cache: {response_cache.stats.as_dict()}")
             print("Thank you for using the religion app. Goodbye!")
             break
 
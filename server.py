@@ -0,0 +1,278 @@
+# Imports
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from embedding_cache import setup_cached_embeddings
+from searcher3 import (
+    ConversationType,
+    Religion,
+    enum_member,
+    initialize_chains,
+    invoke_chain,
+    setup_embeddings_and_vector_store,
+    setup_llm,
+    setup_memory,
+)
+from condense import CONDENSE_STATS
+from context_format import CONTEXT_STATS
+from response_cache import RESPONSE_CACHE_ENABLED, SemanticResponseCache, chain_key
+from streaming import StreamingHandler, TurnMetrics, astream_turn, source_label
+from telemetry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Serving limits
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "16"))  # Threads for blocking embedding and LLM calls
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", "1800"))
+EVICTION_INTERVAL_SECONDS = 60
+
+
+class Session:
+    """One user's conversation: its chain selection and its own bounded memory"""
+
+    def __init__(self, religion, conv_type, llm):
+        self.id = uuid.uuid4().hex
+        self.religion = religion
+        self.conv_type = conv_type
+        self.memory = setup_memory(llm)
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()  # One turn at a time per session
+
+
+class SessionStore:
+    """Sessions in least-recently-used order, bounded in count and idle time"""
+
+    def __init__(self, llm, max_sessions=MAX_SESSIONS, idle_seconds=SESSION_IDLE_SECONDS):
+        self.llm = llm  # Used by each session's memory to summarize older turns
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, religion, conv_type):
+        while len(self.sessions) >= self.max_sessions:
+            self.sessions.popitem(last=False)
+        session = Session(religion, conv_type, self.llm)
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+    def evict_idle(self):
+        """Drops sessions idle for longer than idle_seconds; returns how many were dropped"""
+        cutoff = time.monotonic() - self.idle_seconds
+        evicted = 0
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used > cutoff:
+                break
+            self.sessions.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+def parse_enum(enum_type, value):
+    """enum_member() with a 422 response for unknown values"""
+    try:
+        return enum_member(enum_type, value)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def evict_idle_sessions(sessions):
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL_SECONDS)
+        sessions.evict_idle()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Builds the shared embeddings, retriever, chains and response cache once per process"""
+    state = app.state
+    state.executor = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix="chain")
+    llm = setup_llm()
+    embeddings = setup_cached_embeddings()
+    state.chains = initialize_chains(llm, setup_embeddings_and_vector_store(embeddings))
+    state.response_cache = SemanticResponseCache(embeddings.embed_query) if RESPONSE_CACHE_ENABLED else None
+    state.sessions = SessionStore(llm)
+    eviction = asyncio.create_task(evict_idle_sessions(state.sessions))
+    yield
+    eviction.cancel()
+    state.executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="Biblical Companion AI", lifespan=lifespan)
+
+
+class SessionRequest(BaseModel):
+    religion: str
+    conversation_type: str
+
+
+class MessageRequest(BaseModel):
+    message: str
+
+
+@app.post("/sessions", status_code=201)
+async def create_session(request: SessionRequest):
+    religion = parse_enum(Religion, request.religion)
+    conv_type = parse_enum(ConversationType, request.conversation_type)
+    if conv_type not in app.state.chains[religion]:
+        raise HTTPException(status_code=400, detail=f"{conv_type.value} is not available for {religion.value}")
+    session = app.state.sessions.create(religion, conv_type)
+    return {"session_id": session.id, "religion": religion.value, "conversation_type": conv_type.value}
+
+
+async def lookup_response(key, query, chat_history):
+    """Looks a first-turn question up in the response cache; returns (entry or None, query vector)"""
+    cache = app.state.response_cache
+    if cache is None:
+        return None, None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.executor, cache.lookup, key, query, chat_history)
+
+
+def store_response(key, query, vector, answer, sources, seconds):
+    if vector is not None and answer is not None:
+        app.state.response_cache.store(key, query, vector, answer, sources, seconds)
+
+
+def sources_event(docs):
+    return {"type": "sources", "sources": [{"reference": source_label(doc), "content": doc.page_content} for doc in docs]}
+
+
+@app.post("/sessions/{session_id}/messages")
+async def send_message(session_id: str, request: MessageRequest):
+    session = app.state.sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+
+    chain = app.state.chains[session.religion][session.conv_type]
+    key = chain_key(session.religion, session.conv_type)
+    loop = asyncio.get_running_loop()
+    async with session.lock:
+        chat_history = session.memory.load_memory_variables({})["chat_history"]
+        cached, vector = await lookup_response(key, request.message, chat_history)
+        if cached is not None:
+            answer = cached.answer
+        else:
+            started = time.perf_counter()
+            sources = []
+            collect = lambda event: sources.extend(event[1]) if event[0] == "sources" else None  # noqa: E731
+            answer = await loop.run_in_executor(
+                app.state.executor,
+                lambda: invoke_chain(chain, session.religion, request.message, chat_history,
+                                     callbacks=[StreamingHandler(collect)], conv_type=session.conv_type))
+            store_response(key, request.message, vector, answer, sources, time.perf_counter() - started)
+        session.memory.save_context({"question": request.message}, {"answer": answer})
+    return {"answer": answer, "cached": cached is not None}
+
+
+@app.post("/sessions/{session_id}/messages/stream")
+async def stream_message(session_id: str, request: MessageRequest):
+    """Streams one turn as NDJSON events: sources, tokens, then done with latency metrics"""
+    session = app.state.sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    chain = app.state.chains[session.religion][session.conv_type]
+    key = chain_key(session.religion, session.conv_type)
+
+    async def events():
+        async with session.lock:
+            chat_history = session.memory.load_memory_variables({})["chat_history"]
+            invoke = lambda callbacks: invoke_chain(  # noqa: E731
+                chain, session.religion, request.message, chat_history, callbacks=callbacks, conv_type=session.conv_type)
+            answer = sources = None
+            try:
+                metrics = TurnMetrics()
+                cached, vector = await lookup_response(key, request.message, chat_history)
+                if cached is not None:
+                    # Replay the stored turn as the same event sequence
+                    answer = cached.answer
+                    metrics.on_token()
+                    metrics.finish()
+                    # Nothing was generated, so there is no token rate to report
+                    replayed = {**metrics.as_dict(), "tokens_per_second": None, "cached": True}
+                    for event in (sources_event(cached.sources), {"type": "token", "text": answer},
+                                  {"type": "done", "metrics": replayed}):
+                        yield json.dumps(event, ensure_ascii=False) + "\n"
+                else:
+                    async for kind, payload in astream_turn(invoke, app.state.executor):
+                        if kind == "sources":
+                            sources = payload
+                            event = sources_event(payload)
+                        elif kind == "token":
+                            event = {"type": "token", "text": payload}
+                        elif kind == "done":
+                            answer = payload
+                            continue
+                        else:
+                            turn_metrics = payload.as_dict()
+                            store_response(key, request.message, vector, answer, sources or (),
+                                           turn_metrics["total_time"])
+                            event = {"type": "done", "metrics": {**turn_metrics, "cached": False}}
+                        yield json.dumps(event, ensure_ascii=False) + "\n"
+            except Exception as e:
+                logger.exception("Streamed turn failed for session %s", session.id)
+                yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+            if answer is not None:
+                session.memory.save_context({"question": request.message}, {"answer": answer})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.delete("/sessions/{session_id}", status_code=204)
+async def delete_session(session_id: str):
+    if not app.state.sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "sessions": len(app.state.sessions)}
+
+
+@app.get("/stats")
+async def stats():
+    cache = app.state.response_cache
+    return {
+        "condense": CONDENSE_STATS.as_dict(),
+        "context": CONTEXT_STATS.as_dict(),
+        "response_cache": {**cache.stats.as_dict(), "entries": len(cache)} if cache is not None else None,
+        "telemetry": REGISTRY.dump(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Stage latency histograms, token and cache counters in Prometheus text format"""
+    return REGISTRY.prometheus()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    uvicorn.run(app, host=os.getenv("HOST", "127.0.0.1"), port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,68 @@
+# Imports
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+# One question per turn, reused by every simulated user
+SAMPLE_TURNS = [
+    "What does the Bible say about forgiveness?",
+    "How can I apply that at work?",
+    "Can you suggest a short prayer about it?",
+]
+
+
+async def run_session(client, religion, conversation_type, turns, latencies):
+    """Creates a session, sends each turn in order, then closes the session"""
+    response = await client.post("/sessions", json={"religion": religion, "conversation_type": conversation_type})
+    response.raise_for_status()
+    session_id = response.json()["session_id"]
+    try:
+        for message in turns:
+            started = time.perf_counter()
+            response = await client.post(f"/sessions/{session_id}/messages", json={"message": message})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await client.delete(f"/sessions/{session_id}")
+
+
+async def run(args):
+    latencies = []
+    limits = httpx.Limits(max_connections=args.sessions)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(run_session(client, args.religion, args.conversation_type, SAMPLE_TURNS[:args.turns], latencies)
+              for _ in range(args.sessions)),
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - started
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    print(f"{args.sessions} sessions x {args.turns} turns in {elapsed:.1f}s, {len(errors)} failed sessions")
+    if errors:
+        print(f"First error: {errors[0]!r}")
+    if latencies:
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"Turn latency: p50 {statistics.median(latencies):.2f}s, p99 {p99:.2f}s, "
+              f"throughput {len(latencies) / elapsed:.1f} turns/s")
+
+
+def main():
+    """Drives many concurrent conversations against a running server.py"""
+    parser = argparse.ArgumentParser(description="Concurrent test client for server.py.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=len(SAMPLE_TURNS), choices=range(1, len(SAMPLE_TURNS) + 1))
+    parser.add_argument("--religion", default="Catholicism")
+    parser.add_argument("--conversation-type", default="Bible coach")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
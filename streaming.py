@@ -0,0 +1,142 @@
+# Imports
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Tag on the chain whose LLM call produces the user-facing answer (not the question-condensing call)
+ANSWER_TAG = "answer"
+
+
+class TurnMetrics:
+    """Perceived (time to first token) and total latency of one conversation turn"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+        self.tokens = 0
+
+    def on_token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        logger.info("turn %s", json.dumps(self.as_dict()))
+
+    def as_dict(self):
+        first_token = self.first_token or self.finished
+        generation = (self.finished - first_token) if self.finished and first_token else 0.0
+        return {
+            "time_to_first_token": round(first_token - self.started, 4) if first_token else None,
+            "total_time": round(self.finished - self.started, 4) if self.finished else None,
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens / generation, 2) if generation > 0 else None,
+        }
+
+
+class StreamingHandler(BaseCallbackHandler):
+    """Forwards the answer's tokens and the outermost retriever's documents to emit()"""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.answer_runs = set()
+        self.retriever_runs = set()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+        # Chain tags are not inherited by child runs, so propagate the answer tag down the run tree
+        if ANSWER_TAG in (tags or []) or parent_run_id in self.answer_runs:
+            self.answer_runs.add(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id in self.answer_runs:
+            self.answer_runs.add(run_id)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self.answer_runs:
+            self.emit(("token", token))
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self.retriever_runs.add(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, parent_run_id=None, **kwargs):
+        # Wrapping retrievers (reference fast path, hybrid) call inner retrievers; only report the final list
+        if parent_run_id not in self.retriever_runs:
+            self.emit(("sources", documents))
+
+
+def source_label(doc):
+    """Short reference for a retrieved document, e.g. "John 3:16-25" """
+    metadata = doc.metadata or {}
+    if "reference" in metadata:
+        return metadata["reference"]
+    if "book" in metadata:
+        return f"{metadata['book']} {metadata['chapter']}:{metadata['verses']}"
+    try:
+        chunk = json.loads(doc.page_content)
+        return f"{chunk['book']} {chunk['chapter']}:{chunk['verses']}"
+    except (ValueError, KeyError, TypeError):
+        return doc.page_content[:40]
+
+
+def run_turn(invoke, emit):
+    """Runs invoke(callbacks) and reports ("done", answer) or ("error", exception) through emit()"""
+    try:
+        emit(("done", invoke([StreamingHandler(emit)])))
+    except Exception as e:
+        emit(("error", e))
+
+
+def stream_turn(invoke):
+    """Runs invoke(callbacks) on a worker thread and yields its events as they happen.
+
+    Yields ("sources", documents) before generation starts, then ("token", text)
+    for each streamed token, then ("done", answer) and finally ("metrics", TurnMetrics).
+    If the LLM does not stream, the whole answer arrives as a single token.
+    """
+    events = queue.Queue()
+    metrics = TurnMetrics()
+    threading.Thread(target=run_turn, args=(invoke, events.put), daemon=True).start()
+    yield from _relay(iter(events.get, None), metrics)
+
+
+async def astream_turn(invoke, executor):
+    """Async version of stream_turn, running invoke on executor"""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    metrics = TurnMetrics()
+    emit = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)  # noqa: E731
+    loop.run_in_executor(executor, run_turn, invoke, emit)
+    while True:
+        event = await events.get()
+        for relayed in _relay([event], metrics):
+            yield relayed
+        if event[0] in ("done", "error"):
+            return
+
+
+def _relay(events, metrics):
+    for kind, payload in events:
+        if kind == "token":
+            metrics.on_token()
+            yield kind, payload
+        elif kind == "sources":
+            yield kind, payload
+        elif kind == "error":
+            raise payload
+        elif kind == "done":
+            if metrics.tokens == 0 and payload:
+                metrics.on_token()
+                yield "token", payload
+            metrics.finish()
+            yield kind, payload
+            yield "metrics", metrics
+            return
@@ -0,0 +1,104 @@
+# Imports
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.messages import SystemMessage, get_buffer_string
+from pydantic import PrivateAttr
+
+from context_format import approximate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# Token budget for the raw messages replayed into {chat_history}
+MEMORY_TOKEN_LIMIT = int(os.getenv("MEMORY_TOKEN_LIMIT", "1000"))
+
+# Summaries are computed here, never on the thread answering the user
+SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+
+class SummarizingTokenBufferMemory(BaseChatMemory):
+    """Keeps recent messages up to max_token_limit and folds older ones into a running summary.
+
+    Evicted messages are summarized on SUMMARY_EXECUTOR, so save_context returns
+    immediately; until a summary update lands, the turns being folded are simply
+    left out of the history. A last exchange that alone exceeds the limit is kept
+    with its answer (then its question) truncated.
+    """
+
+    llm: Any
+    memory_key: str = "chat_history"
+    max_token_limit: int = MEMORY_TOKEN_LIMIT
+    summary: str = ""
+    _pending: list = PrivateAttr(default_factory=list)
+    _summarizing: bool = PrivateAttr(default=False)
+    _generation: int = PrivateAttr(default=0)  # Bumped by clear() so in-flight summaries are discarded
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        with self._lock:
+            messages = list(self.chat_memory.messages)
+            summary = self.summary
+        if summary:
+            messages = [SystemMessage(content=f"Summary of the earlier conversation: {summary}")] + messages
+        return {self.memory_key: messages if self.return_messages else get_buffer_string(messages)}
+
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        self._prune()
+
+    def _prune(self):
+        """Moves the oldest messages out of the buffer until it fits, truncating the last exchange if it must"""
+        with self._lock:
+            buffer = self.chat_memory.messages
+            total = sum(approximate_tokens(message.content) for message in buffer)
+            while total > self.max_token_limit and len(buffer) > 2:
+                message = buffer.pop(0)
+                total -= approximate_tokens(message.content)
+                self._pending.append(message)
+            for i in reversed(range(len(buffer))):
+                if total <= self.max_token_limit:
+                    break
+                tokens = approximate_tokens(buffer[i].content)
+                # At least an even share of the limit, so a long question does not wipe out the answer
+                budget = max(self.max_token_limit - (total - tokens), self.max_token_limit // len(buffer))
+                content = truncate_to_tokens(buffer[i].content, budget)
+                buffer[i] = buffer[i].model_copy(update={"content": content})
+                total += approximate_tokens(content) - tokens
+            if not self._pending or self._summarizing:
+                return
+            self._summarizing = True
+        SUMMARY_EXECUTOR.submit(self._summarize)
+
+    def _summarize(self):
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                summary, generation = self.summary, self._generation
+                if not batch:
+                    self._summarizing = False
+                    return
+            try:
+                prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=get_buffer_string(batch))
+                result = self.llm.invoke(prompt)
+                with self._lock:
+                    # A clear() while the LLM was running started a new conversation
+                    if generation == self._generation:
+                        self.summary = getattr(result, "content", result).strip()
+            except Exception:
+                logger.exception("Summarizing %d messages failed; they are dropped from the history", len(batch))
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self.summary = ""
+            self._pending = []
+            self._generation += 1
@@ -0,0 +1,274 @@
+# Imports
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from context_format import approximate_tokens
+from streaming import ANSWER_TAG, source_label
+
+logger = logging.getLogger(__name__)
+
+# Stages of a turn. "embed" and "context" (compaction) happen inside "retrieve".
+TURN_STAGES = ("condense", "embed", "retrieve", "context", "prompt", "generate")
+
+# Histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are estimated as the upper bound of the bucket they fall in"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class MetricsRegistry:
+    """In-process histograms and counters, dumpable as a dict or as Prometheus text"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def dump(self):
+        with self._lock:
+            return {
+                "histograms": {_series(name, dict(labels)): h.as_dict() for (name, labels), h in self.histograms.items()},
+                "counters": {_series(name, dict(labels)): value for (name, labels), value in self.counters.items()},
+            }
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                labels = dict(labels)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{_series(name + '_bucket', {**labels, 'le': le})} {cumulative}")
+                lines.append(f"{_series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{_series(name, dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+_CURRENT_TURN = ContextVar("current_turn", default=None)
+
+
+class TurnTrace:
+    """Stage timings, token counts, retrieved chunks and cache hits of one conversation turn"""
+
+    def __init__(self, **labels):
+        self.id = uuid.uuid4().hex
+        self.labels = {key: value for key, value in labels.items() if value is not None}
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.chunks = []
+        self.cache = {}
+        self.total = None
+        self.error = None
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_cache(self, cache, hit):
+        counts = self.cache.setdefault(cache, {"hits": 0, "misses": 0})
+        counts["hits" if hit else "misses"] += 1
+
+    def finish(self, error=None):
+        self.total = time.perf_counter() - self.started
+        self.error = repr(error) if error is not None else None
+        REGISTRY.observe("turn_seconds", self.total, **self.labels)
+        REGISTRY.increment("turns_total", status="error" if error else "ok")
+        REGISTRY.increment("llm_tokens_total", self.prompt_tokens, kind="prompt")
+        REGISTRY.increment("llm_tokens_total", self.completion_tokens, kind="completion")
+        logger.info(json.dumps({"event": "turn", **self.as_dict()}, ensure_ascii=False))
+
+    def as_dict(self):
+        return {
+            "turn_id": self.id,
+            **self.labels,
+            "total_seconds": round(self.total, 6) if self.total is not None else None,
+            "stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "chunks": self.chunks,
+            "cache": self.cache,
+            "error": self.error,
+        }
+
+
+def record_stage(stage, seconds):
+    """Adds a stage timing to the registry and to the turn being traced, if any"""
+    REGISTRY.observe("stage_seconds", seconds, stage=stage)
+    trace = _CURRENT_TURN.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+def record_cache(cache, hit):
+    REGISTRY.increment("cache_hits_total" if hit else "cache_misses_total", cache=cache)
+    trace = _CURRENT_TURN.get()
+    if trace is not None:
+        trace.add_cache(cache, hit)
+
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+@contextmanager
+def trace_turn(**labels):
+    """Traces the turn run inside the block; the trace is logged as one JSON line when it ends"""
+    trace = TurnTrace(**labels)
+    token = _CURRENT_TURN.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.finish(error=e)
+        raise
+    else:
+        trace.finish()
+    finally:
+        _CURRENT_TURN.reset(token)
+
+
+class TelemetryHandler(BaseCallbackHandler):
+    """Times condensing, retrieval, compaction, prompt assembly and generation from LangChain callbacks"""
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.started = {}
+        self.answer_runs = set()
+        self.retriever_runs = set()
+        self.compaction_runs = set()
+        self.context_started = None
+        self.prompt_started = None
+
+    def _end(self, run_id):
+        stage, started = self.started.pop(run_id, (None, None))
+        if stage is not None:
+            record_stage(stage, time.perf_counter() - started)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+        # Same propagation as StreamingHandler: chain tags are not inherited by child runs
+        if ANSWER_TAG in (tags or []) or parent_run_id in self.answer_runs:
+            self.answer_runs.add(run_id)
+        if kwargs.get("name") == "CondenseQuestionChain":
+            self.started[run_id] = ("condense", time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        if kwargs.get("name") == "CompactContextRetriever":
+            self.compaction_runs.add(run_id)
+        if parent_run_id not in self.retriever_runs:
+            self.started[run_id] = ("retrieve", time.perf_counter())
+        self.retriever_runs.add(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id in self.compaction_runs:
+            # The wrapped retriever is done; the rest of the compaction run is formatting and budgeting
+            self.context_started = time.perf_counter()
+        elif run_id in self.compaction_runs and self.context_started is not None:
+            record_stage("context", time.perf_counter() - self.context_started)
+            self.context_started = None
+        if parent_run_id in self.retriever_runs:
+            return
+        # Outermost retriever: these are the documents the prompt receives
+        self._end(run_id)
+        self.prompt_started = time.perf_counter()
+        self.trace.chunks = [
+            {"id": doc.id if doc.id is not None else doc.metadata.get("_id"), "reference": source_label(doc),
+             "score": doc.metadata.get("score")}
+            for doc in documents
+        ]
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        now = time.perf_counter()
+        self.trace.prompt_tokens += sum(approximate_tokens(prompt) for prompt in prompts)
+        if parent_run_id in self.answer_runs:
+            self.answer_runs.add(run_id)
+            # From retrieval results (or the start of the turn) to the formatted answer prompt
+            record_stage("prompt", now - (self.prompt_started or self.trace.started))
+            self.started[run_id] = ("generate", now)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+        self.trace.completion_tokens += sum(
+            approximate_tokens(generation.text) for generations in response.generations for generation in generations)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)